@@ -23,40 +23,696 @@ This prevents inconsisitencies that may arise from pickling ambiguities.
   expensive_computation(1)  # (c) returns the cached results from (a)
 
   another_expensive_computation(2)  # (d) runs another_expensive_comptuation(2)
-  another_expensive_computation(3)  # (e) returns the cached results from (d)"""
+  another_expensive_computation(3)  # (e) returns the cached results from (d)
 
+Namespaces can additionally be configured with per-process options,
+either through ``configure(ns, ...)'' or as keyword arguments to the
+decorators:
+
+  local_size - keep up to this many entries of the namespace in a
+    per-process LRU in front of the Django backend. Hits in the LRU
+    never leave the process.
+  local_bytes - also cap the per-process LRU at approximately this
+    many (pickled) bytes.
+  local_timeout - serve a local copy for at most this many seconds
+    (default and upper bound: what is left of the value's backend
+    timeout, so local copies never outlive the backend entry).
+
+  single_flight - on a miss, only one caller recomputes the value:
+    threads in this process wait for a single computation, and a
+    lease (taken with an atomic ``add'' on the backend) lets only one
+    process compute at a time. The others poll the backend.
+  lease_timeout - a lease expires after this many seconds, in case its
+    holder dies (default: 30).
+  lease_wait - callers waiting on another process's computation give
+    up after this many seconds (default: 5), and compute the value
+    themselves unless there is a stale copy. Threads in this process
+    share the first one's result, or its exception.
+  stale_timeout - keep a stale copy of every value for this many
+    seconds, to be served to callers that gave up waiting.
+  soft_timeout - values older than this many seconds are still served,
+    but are recomputed in the background (by a fixed pool of
+    REFRESH_THREADS threads, see ``refresh_counters'') and written
+    back. Only one refresh per key runs at a time, across processes.
+  negative_timeout - cache None and empty results for at most this
+    many seconds. (None results are cached like any other value; by
+    default for the full namespace timeout.)
+  compress_threshold - zlib compress values that pickle to at least
+    this many bytes.
+  chunk_size - split values that (pickled and possibly compressed)
+    are larger than this many bytes across several keys, so that
+    values above the backend's item size limit (1MB for memcached) can
+    be cached. All chunks are written in one round trip; a value with
+    any of its chunks missing is a miss.
+
+  @cache('hot_computation', 60*60, local_size=1000, local_timeout=60)
+  def hot_computation(param):
+      ...
+
+Values served from the per-process LRU are shared between callers,
+so they must not be mutated.
+
+Every namespace keeps in-process counters of hits, misses, errors,
+compute time, backend round trips and their latency and the sizes of
+stored values (estimated from a sample, unless the namespace encodes
+its values); see ``stats'', ``log_stats'' and ``log_stats_every''.
+
+Every key also includes a generation number of its namespace, which
+``invalidate_namespace(ns)'' bumps, dropping all of the namespace's
+entries at once. Processes reread the generation every
+GENERATION_TIMEOUT seconds, so other processes may keep serving old
+entries for that long."""
+
+from __future__ import with_statement
+
+import os
+import Queue
+import cPickle
 import inspect
+import random
+import sys
+import threading
+import time
+import zlib
+from itertools import count
 from decorator import decorator
 
 import django.core.cache as dcache
 
 from . import digest
+from .logging import mixlog
+from .lru import LRU
+from .storage import Storage
+
+__all__ = ['cache_', 'cache_key_', 'cache_many_', 'cache', 'cache_key',
+           'configure', 'invalidate_cache_key', 'invalidate_namespace',
+           'refresh_counters', 'stats', 'log_stats', 'log_stats_every']
+
+log = mixlog()
+
+REFRESH_THREADS = 4
+REFRESH_QUEUE_SIZE = 1000
+GENERATION_TIMEOUT = 5
+STATS_STRIPES = 16
+SIZE_SAMPLE = 64
+
+# Generations are stored for the longest relative memcached timeout.
+_generation_backend_timeout = 60*60*24*30
+
+_defaults = Storage(local_size=None, local_bytes=None, local_timeout=None,
+                    single_flight=False, lease_timeout=30, lease_wait=5,
+                    stale_timeout=None, soft_timeout=None,
+                    negative_timeout=None, compress_threshold=None,
+                    chunk_size=None, local=None, stats=None)
+_namespaces = {}
+_unhashable = None
+
+# ns (or its generation key, if unhashable) -> generation, as last
+# read from the backend.
+_generations = LRU(maxsize=10000)
+
+# key -> _Flight of the computation in progress in this process.
+_flights = {}
+_flights_lock = threading.Lock()
+
+def configure(ns, **options):
+    """Set options (see the module documentation) for the namespace
+    `ns', which must be hashable. Options not given keep their
+    current values."""
+    unknown = set(options) - (set(_defaults) - set(['local', 'stats']))
+    if unknown:
+        raise TypeError('unknown cache options: %s' % ', '.join(unknown))
+
+    config = Storage(_config(ns))
+    config.update(options)
+    if config.local_size is not None or config.local_bytes is not None:
+        config.local = LRU(maxsize=config.local_size,
+                           maxbytes=config.local_bytes,
+                           sizeof=_approx_size)
+    else:
+        config.local = None
+    _namespaces[ns] = config
+
+def _config(ns):
+    global _unhashable
+    try:
+        config = _namespaces.get(ns)
+    except TypeError:
+        # Unhashable namespaces can't be configured, and share their
+        # counters.
+        if _unhashable is None:
+            _unhashable = Storage(_defaults, stats=_Counters())
+        return _unhashable
+
+    if config is None:
+        config = _namespaces.setdefault(
+            ns, Storage(_defaults, stats=_Counters()))
+    return config
+
+_counter_names = ['hits', 'local_hits', 'misses', 'errors',
+                  'computes', 'compute_seconds', 'gets', 'get_seconds',
+                  'sets', 'set_seconds', 'set_bytes']
+
+_stripe_ids = count()
+_stripe = threading.local()
+
+class _Counters(object):
+    """Counters of a namespace. Every thread sticks to one of
+    STATS_STRIPES sets of counters (with their own lock), which are
+    summed up for snapshots."""
+
+    def __init__(self):
+        self.stripes = [(threading.Lock(), dict.fromkeys(_counter_names, 0))
+                        for _ in xrange(STATS_STRIPES)]
+        self.size_lock = threading.Lock()
+        self.sized = self.sampled = self.sampled_bytes = 0
+
+    def approx_size(self, value):
+        """Estimate the pickled size of `value' from a sample of the
+        values seen: the first SIZE_SAMPLE, and every SIZE_SAMPLE'th
+        after that."""
+        with self.size_lock:
+            self.sized += 1
+            sample = (self.sampled < SIZE_SAMPLE or
+                      self.sized % SIZE_SAMPLE == 0)
+        if sample:
+            size = _approx_size(value)
+            if size != float('inf'):
+                with self.size_lock:
+                    self.sampled += 1
+                    self.sampled_bytes += size
+        with self.size_lock:
+            return self.sampled and self.sampled_bytes // self.sampled
+
+    def add(self, **counts):
+        try:
+            stripe = _stripe.id
+        except AttributeError:
+            stripe = _stripe.id = _stripe_ids.next() % STATS_STRIPES
+
+        lock, counters = self.stripes[stripe]
+        with lock:
+            for name, value in counts.iteritems():
+                counters[name] += value
+
+    def snapshot(self):
+        total = dict.fromkeys(_counter_names, 0)
+        for lock, counters in self.stripes:
+            with lock:
+                for name, value in counters.iteritems():
+                    total[name] += value
+        return total
+
+def stats():
+    """Return a dictionary of namespaces to a snapshot of their
+    counters in this process (unhashable namespaces are summed up
+    under None). Times are in seconds, sizes in bytes."""
+    snapshot = dict((ns, config.stats.snapshot())
+                    for ns, config in _namespaces.items())
+    if _unhashable is not None:
+        snapshot[None] = _unhashable.stats.snapshot()
+    return snapshot
 
-__all__ = ['cache_', 'cache_key_', 'cache', 'cache_key']
+def log_stats():
+    """Log a line of counters for every namespace."""
+    for ns, counters in sorted(stats().items()):
+        lookups = counters['hits'] + counters['misses']
+        log.info('%r: %d%% hits (%d local) of %d, %d errors, '
+                 '%d computes in %.1fs, %d gets in %.1fs, '
+                 '%d sets of %d bytes in %.1fs',
+                 ns, lookups and 100 * counters['hits'] // lookups,
+                 counters['local_hits'], lookups, counters['errors'],
+                 counters['computes'], counters['compute_seconds'],
+                 counters['gets'], counters['get_seconds'],
+                 counters['sets'], counters['set_bytes'],
+                 counters['set_seconds'])
+
+def log_stats_every(interval):
+    """Start a thread that calls ``log_stats'' every `interval'
+    seconds."""
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                log_stats()
+            except Exception:
+                log.exception('Logging cache stats failed')
+
+    thread = threading.Thread(target=run)
+    thread.setDaemon(True)
+    thread.start()
+    return thread
+
+def _approx_size(value):
+    if isinstance(value, str):
+        return len(value)
+    try:
+        return len(cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL))
+    except (cPickle.PicklingError, TypeError):
+        # The backend won't take it either; don't keep it locally.
+        return float('inf')
 
 
 def _mk_key(ns, obj):
-    """ Combines namespace and a 128 bit hash of object into a compact string.
-    obj will only be pickled if it is not already a string. """
+    """ Combines namespace, its generation and a 128 bit hash of object
+    into a compact string. obj is hashed by its canonical encoding (see
+    util.digest.canonical_digest) if it is not already a string. """
+    generation = _generation(ns)
     if isinstance(obj, basestring):
-        hash = digest.pydigest_str('%s:%s' % (ns, obj))
+        hash = digest.pydigest_str('%s:%d:%s' % (ns, generation, obj))
     else:
-        hash = digest.pydigest((ns, obj))
+        hash = digest.canonical_digest((ns, generation, obj))
     return 'util.cache.' + hash
 
+def _generation_key(ns):
+    if isinstance(ns, basestring):
+        hash = digest.pydigest_str(ns)
+    else:
+        hash = digest.canonical_digest(ns)
+    return 'util.cache.generation.' + hash
+
+def _generation_local_key(ns):
+    try:
+        hash(ns)
+        return ns
+    except TypeError:
+        return _generation_key(ns)
+
+def _generation(ns):
+    local_key = _generation_local_key(ns)
+    generation = _generations.get(local_key)
+    if generation is None:
+        key = _generation_key(ns)
+        generation = dcache.cache.get(key)
+        if generation is None:
+            # Start from the current time rather than 0, so that the
+            # generations of an evicted namespace aren't reused.
+            dcache.cache.add(key, int(time.time()),
+                             _generation_backend_timeout)
+            generation = dcache.cache.get(key, 0)
+        _generations.set(local_key, generation, GENERATION_TIMEOUT)
+
+    return generation
+
+
+class _Entry(object):
+    """A value stored with the time it should be refreshed by (if
+    soft_timeout is set) and the time its backend entry expires (if
+    it may be copied locally)."""
+    def __init__(self, value, refresh_at=None, expires_at=None):
+        self.value = value
+        self.refresh_at = refresh_at
+        self.expires_at = expires_at
+
+class _NoneType(object):
+    """Stands in for a stored None, which the backend would report as
+    a miss."""
+
+_none = _NoneType()
+
+def _cache(ns, key, timeout, fun, *args, **kwargs):
+    config = _config(ns)
+    local = config.local
+    value = None
+    if local is not None:
+        value = local.get(key)
+        if value is not None:
+            config.stats.add(hits=1, local_hits=1)
+
+    if value is None:
+        value = _get(config, key)
+        if value is not None:
+            config.stats.add(hits=1)
+        else:
+            config.stats.add(misses=1)
+            if config.single_flight:
+                value = _single_flight(config, key, timeout, fun, args, kwargs)
+            else:
+                value = _compute(config, key, timeout, fun, args, kwargs)
+
+        if local is not None:
+            local.set(key, value, _local_timeout(config, value, timeout))
 
-def _cache(key, timeout, fun, *args, **kwargs):
-    value = dcache.cache.get(key)
+    return _unwrap(config, key, value, timeout, fun, args, kwargs)
+
+def _unwrap(config, key, value, timeout, fun, args, kwargs):
+    """Return the value of a stored object, scheduling a refresh if it
+    is due."""
+    if isinstance(value, _Entry):
+        if value.refresh_at is not None and value.refresh_at <= time.time():
+            _refresher.schedule(config, key, timeout, fun, args, kwargs)
+        value = value.value
+
+    if isinstance(value, _NoneType):
+        value = None
+    return value
+
+def _wrap(config, value, timeout):
     if value is None:
+        value = _none
+    if config.soft_timeout or config.local is not None:
+        now = time.time()
+        refresh_at = expires_at = None
+        if config.soft_timeout:
+            refresh_at = now + config.soft_timeout
+        if config.local is not None:
+            expires_at = now + _timeout(config, value, timeout)
+        value = _Entry(value, refresh_at, expires_at)
+    return value
+
+def _timeout(config, value, timeout):
+    """The backend timeout for the stored object `value'."""
+    if config.negative_timeout is not None:
+        if isinstance(value, _Entry):
+            value = value.value
+        if (isinstance(value, _NoneType) or
+            (isinstance(value, (basestring, list, tuple, dict,
+                                set, frozenset)) and not value)):
+            return min(timeout, config.negative_timeout)
+    return timeout
+
+def _local_timeout(config, value, timeout):
+    timeout = _timeout(config, value, timeout)
+    if isinstance(value, _Entry) and value.expires_at is not None:
+        # What's left of the backend entry's timeout.
+        timeout = min(timeout, max(0, value.expires_at - time.time()))
+    return min(timeout, config.local_timeout or timeout)
+
+def _store(config, key, value, timeout):
+    """Store `value' in the backend, returning what was stored."""
+    value = _wrap(config, value, timeout)
+    _set(config, key, value, _timeout(config, value, timeout))
+    if config.stale_timeout:
+        _set(config, key + '.stale', value, config.stale_timeout)
+    return value
+
+# Namespaces with compress_threshold or chunk_size set store their
+# values in the backend as strings: 'P' followed by the pickled value,
+# 'Z' followed by the compressed pickled value, or a manifest of chunks
+# 'C<P or Z>:<nonce>:<count>'. The chunks themselves are stored under
+# '<key>.<nonce>.<index>'; the nonce keeps chunks of different writes
+# apart.
+
+def _encodes(config):
+    return config.compress_threshold is not None or config.chunk_size
+
+def _get(config, key):
+    if not _encodes(config):
+        begin = time.time()
+        value = dcache.cache.get(key)
+        config.stats.add(gets=1, get_seconds=time.time() - begin)
+        return value
+    return _get_many(config, [key]).get(key)
+
+def _set(config, key, value, timeout):
+    _set_many(config, {key: value}, timeout)
+
+def _get_many(config, keys):
+    begin = time.time()
+    values = dcache.cache.get_many(keys)
+    config.stats.add(gets=1, get_seconds=time.time() - begin)
+    if not _encodes(config):
+        return values
+
+    manifests = {}
+    for key, data in values.iteritems():
+        if isinstance(data, str) and data.startswith('C'):
+            try:
+                manifests[key] = _chunk_keys(key, data)
+            except ValueError:
+                # Not a manifest after all: fails to decode below.
+                pass
+
+    chunks = {}
+    if manifests:
+        begin = time.time()
+        chunks = dcache.cache.get_many(
+            [chunk for keys in manifests.itervalues() for chunk in keys])
+        config.stats.add(gets=1, get_seconds=time.time() - begin)
+
+    decoded = {}
+    for key, data in values.iteritems():
         try:
-            value = fun(*args, **kwargs)
-            dcache.cache.set(key, value, timeout)
-        except:
-            # Always invalidate cache on any exception.
-            dcache.cache.delete(key)
-            raise
+            if key in manifests:
+                parts = [chunks.get(chunk) for chunk in manifests[key]]
+                if None in parts:
+                    continue
+                data = data[1] + ''.join(parts)
+            decoded[key] = _decode(data)
+        except Exception:
+            # Most likely stored before the namespace was configured
+            # to encode its values.
+            log.warning('Failed to decode %s, ignoring it', key)
+
+    return decoded
+
+def _set_many(config, values, timeout):
+    if _encodes(config):
+        encoded = {}
+        for key, value in values.iteritems():
+            encoded.update(_encode(config, key, value))
+        values = encoded
+        size = sum(len(data) for data in encoded.itervalues())
+    else:
+        # The backend pickles the values itself: pickling them all
+        # again just to count them would double the cost of a set.
+        size = sum(config.stats.approx_size(value)
+                   for value in values.itervalues())
+
+    begin = time.time()
+    if len(values) == 1:
+        ((key, value),) = values.items()
+        dcache.cache.set(key, value, timeout)
+    else:
+        dcache.cache.set_many(values, timeout)
+    config.stats.add(sets=1, set_seconds=time.time() - begin,
+                     set_bytes=size)
+
+def _encode(config, key, value):
+    """Return a dictionary of the backend keys and values to store
+    `value' under `key'."""
+    data = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+    kind = 'P'
+    if (config.compress_threshold is not None and
+        len(data) >= config.compress_threshold):
+        data = zlib.compress(data)
+        kind = 'Z'
+
+    size = config.chunk_size
+    if not size or len(data) <= size:
+        return {key: kind + data}
+
+    nonce = '%08x' % random.getrandbits(32)
+    count = (len(data) + size - 1) // size
+    encoded = dict(('%s.%s.%d' % (key, nonce, i), data[i*size:(i+1)*size])
+                   for i in xrange(count))
+    encoded[key] = 'C%s:%s:%d' % (kind, nonce, count)
+    return encoded
+
+def _chunk_keys(key, manifest):
+    _, nonce, count = manifest.split(':')
+    return ['%s.%s.%d' % (key, nonce, i) for i in xrange(int(count))]
+
+def _decode(data):
+    kind, data = data[0], data[1:]
+    if kind == 'Z':
+        data = zlib.decompress(data)
+    elif kind != 'P':
+        raise ValueError('unknown encoding %r' % kind)
+    return cPickle.loads(data)
+
+def _call(config, fun, args, kwargs):
+    begin = time.time()
+    try:
+        return fun(*args, **kwargs)
+    except:
+        config.stats.add(errors=1)
+        raise
+    finally:
+        config.stats.add(computes=1, compute_seconds=time.time() - begin)
+
+def _compute(config, key, timeout, fun, args, kwargs):
+    try:
+        value = _store(config, key, _call(config, fun, args, kwargs), timeout)
+    except:
+        # Always invalidate cache on any exception.
+        if config.local is not None:
+            config.local.pop(key, None)
+        dcache.cache.delete(key)
+        raise
+
     return value
 
+class _Flight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.ok = False
+        self.value = None
+        self.error = None
+
+def _single_flight(config, key, timeout, fun, args, kwargs):
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = _Flight()
+
+    if not leader:
+        # The leader may itself wait out somebody else's lease before
+        # computing the value, or falling back to the stale copy.
+        flight.done.wait(config.lease_wait + config.lease_timeout)
+        if flight.ok:
+            return flight.value
+        if flight.error is not None:
+            # Rather than all retrying at once.
+            raise flight.error[0], flight.error[1], flight.error[2]
+        # The leader is taking too long.
+        return _stale_or_compute(config, key, timeout, fun, args, kwargs)
+
+    try:
+        flight.value = _leased(config, key, timeout, fun, args, kwargs)
+        flight.ok = True
+        return flight.value
+    except:
+        flight.error = sys.exc_info()
+        raise
+    finally:
+        with _flights_lock:
+            del _flights[key]
+        flight.done.set()
+
+def _leased(config, key, timeout, fun, args, kwargs):
+    """Compute the value if we get the lease for `key', otherwise wait
+    for whoever holds it to store the value."""
+    lease = key + '.lease'
+    if dcache.cache.add(lease, 1, config.lease_timeout):
+        try:
+            # The previous holder may have stored the value since we
+            # missed it.
+            value = _get(config, key)
+            if value is not None:
+                return value
+            return _compute(config, key, timeout, fun, args, kwargs)
+        finally:
+            dcache.cache.delete(lease)
+
+    deadline = time.time() + config.lease_wait
+    delay = 0.01
+    while True:
+        now = time.time()
+        if now >= deadline:
+            break
+        time.sleep(min(delay, deadline - now))
+        delay = min(2 * delay, 0.5)
+
+        value = _get(config, key)
+        if value is not None:
+            return value
+
+    return _stale_or_compute(config, key, timeout, fun, args, kwargs)
+
+def _stale_or_compute(config, key, timeout, fun, args, kwargs):
+    if config.stale_timeout:
+        value = _get(config, key + '.stale')
+        if value is not None:
+            return value
+    return _compute(config, key, timeout, fun, args, kwargs)
+
+def _refresh(config, key, timeout, fun, args, kwargs):
+    """Recompute and store the value for `key' unless somebody else
+    already is, or already has. A failed refresh leaves the current
+    value in place."""
+    lease = key + '.lease'
+    if not dcache.cache.add(lease, 1, config.lease_timeout):
+        return False
+
+    try:
+        value = _get(config, key)
+        refreshed = not (isinstance(value, _Entry) and
+                         value.refresh_at is not None and
+                         value.refresh_at > time.time())
+        if refreshed:
+            value = _store(config, key, _call(config, fun, args, kwargs),
+                           timeout)
+    finally:
+        dcache.cache.delete(lease)
+
+    if config.local is not None:
+        config.local.set(key, value, _local_timeout(config, value, timeout))
+    return refreshed
+
+class _Refresher(object):
+    """A fixed pool of threads refreshing soft-expired values. Keys
+    that are already queued or being refreshed are not queued again."""
+
+    def __init__(self, nthreads, queue_size):
+        self.nthreads = nthreads
+        self.queue_size = queue_size
+        self.lock = threading.Lock()
+        self.pid = None
+        self.queue = None
+        self.pending = set()
+        self.counters = dict.fromkeys(
+            ['scheduled', 'deduplicated', 'dropped',
+             'refreshed', 'leased', 'failed'], 0)
+
+    def schedule(self, config, key, timeout, fun, args, kwargs):
+        with self.lock:
+            if self.pid != os.getpid():
+                self._start()
+
+            if key in self.pending:
+                self.counters['deduplicated'] += 1
+                return
+
+            try:
+                self.queue.put_nowait(
+                    (config, key, timeout, fun, args, kwargs))
+            except Queue.Full:
+                self.counters['dropped'] += 1
+                return
+
+            self.pending.add(key)
+            self.counters['scheduled'] += 1
+
+    def _start(self):
+        # Threads don't survive a fork, so (re)start them lazily in
+        # every process that needs them.
+        self.pid = os.getpid()
+        self.queue = Queue.Queue(self.queue_size)
+        self.pending.clear()
+        for _ in xrange(self.nthreads):
+            thread = threading.Thread(target=self._run, args=(self.queue,))
+            thread.setDaemon(True)
+            thread.start()
+
+    def _run(self, queue):
+        while True:
+            job = queue.get()
+            key = job[1]
+            try:
+                if _refresh(*job):
+                    counter = 'refreshed'
+                else:
+                    counter = 'leased'
+            except Exception:
+                log.exception('Refreshing %s failed', key)
+                counter = 'failed'
+
+            with self.lock:
+                self.pending.discard(key)
+                self.counters[counter] += 1
+
+_refresher = _Refresher(REFRESH_THREADS, REFRESH_QUEUE_SIZE)
+
+def refresh_counters():
+    """Return a dictionary of counters of background refreshes in this
+    process: how many were scheduled, deduplicated (already pending),
+    dropped (the queue was full), refreshed, leased (another process
+    was refreshing, or already had) and failed."""
+    with _refresher.lock:
+        return dict(_refresher.counters)
+
 def cache_(ns, timeout, fun, *args, **kwargs):
     """Return the results of ``fun(*args, **kwargs)'', using a cached
     version if available, and caching the result if it is run. `ns'
@@ -67,34 +723,175 @@ def cache_(ns, timeout, fun, *args, **kwargs):
         key = fun._cache_keyfunc(*args, **kwargs)
     else:
         key = args, frozenset(kwargs.iteritems())
-    return _cache(_mk_key(ns, key), timeout, fun, *args, **kwargs)
+    return _cache(ns, _mk_key(ns, key), timeout, fun, *args, **kwargs)
 
 def cache_key_(ns, timeout, keyfun, fun, *args, **kwargs):
     """Cache, but specify a key function."""
     key = keyfun(*args, **kwargs)
-    return _cache(_mk_key(ns, key), timeout, fun, *args, **kwargs)
+    return _cache(ns, _mk_key(ns, key), timeout, fun, *args, **kwargs)
+
+def cache_many_(ns, timeout, fun, argslist, batch=None):
+    """Return the results of calling `fun' with each of the argument
+    tuples in `argslist' (non-tuples are taken as the only argument),
+    like calling ``cache_'' for each of them, but looking up all keys
+    in one round trip. The misses are computed by ``fun'', or in one
+    call of ``batch(missing_argslist)'' if given, which must return
+    the results in the same order, and are stored in one round trip,
+    too. Misses are not single-flighted."""
+    config = _config(ns)
+    local = config.local
+    keyfunc = getattr(fun, '_cache_keyfunc', None)
+
+    argslist = [args if isinstance(args, tuple) else (args,)
+                for args in argslist]
+    keys = [_mk_key(ns, keyfunc(*args) if keyfunc is not None
+                    else (args, frozenset()))
+            for args in argslist]
+
+    found = {}
+    if local is not None:
+        for key in keys:
+            value = local.get(key)
+            if value is not None:
+                found[key] = value
+        config.stats.add(hits=len(found), local_hits=len(found))
+
+    remote = [key for key in set(keys) if key not in found]
+    if remote:
+        fetched = _get_many(config, remote)
+        config.stats.add(hits=len(fetched),
+                         misses=len(remote) - len(fetched))
+        if local is not None:
+            for key, value in fetched.iteritems():
+                local.set(key, value, _local_timeout(config, value, timeout))
+        found.update(fetched)
+
+    missing = {}
+    for key, args in zip(keys, argslist):
+        if key not in found:
+            missing.setdefault(key, args)
 
-def cache(ns, timeout):
+    if missing:
+        found.update(_compute_many(config, missing, timeout, fun, batch))
+
+    return [_unwrap(config, key, found[key], timeout, fun, args, {})
+            for key, args in zip(keys, argslist)]
+
+def _compute_many(config, missing, timeout, fun, batch):
+    """Compute and store the values for `missing', a dictionary of
+    keys to argument tuples, returning a dictionary of what was
+    stored."""
+    keys = missing.keys()
+    try:
+        if batch is not None:
+            values = list(_call(config, batch,
+                                ([missing[key] for key in keys],), {}))
+            if len(values) != len(keys):
+                raise ValueError('%s returned %d results for %d arguments' %
+                                 (getattr(batch, '__name__', batch),
+                                  len(values), len(keys)))
+        else:
+            values = [_call(config, fun, missing[key], {}) for key in keys]
+
+        stored = dict((key, _wrap(config, value, timeout))
+                      for key, value in zip(keys, values))
+        by_timeout = {}
+        for key, value in stored.iteritems():
+            by_timeout.setdefault(_timeout(config, value, timeout),
+                                  {})[key] = value
+        for key_timeout, values in by_timeout.iteritems():
+            _set_many(config, values, key_timeout)
+        if config.stale_timeout:
+            _set_many(config,
+                dict((key + '.stale', value)
+                     for key, value in stored.iteritems()),
+                config.stale_timeout)
+    except:
+        # Always invalidate cache on any exception.
+        for key in keys:
+            if config.local is not None:
+                config.local.pop(key, None)
+            dcache.cache.delete(key)
+        raise
+
+    if config.local is not None:
+        for key, value in stored.iteritems():
+            config.local.set(key, value,
+                             _local_timeout(config, value, timeout))
+
+    return stored
+
+def cache(ns, timeout, batch=None, **options):
     """Return a decorator to cache the results of the decorated
-    function for the namespace `ns'."""
-    @decorator
+    function for the namespace `ns'. `options' configure the
+    namespace (see ``configure'').
+
+    The decorated function also gets a ``many(argslist)'' method
+    which looks up many results at once (see ``cache_many_''),
+    computing misses with `batch' if given."""
+    if options:
+        configure(ns, **options)
+
     def wrapper(fun, *args, **kwargs):
         return cache_(ns, timeout, fun, *args, **kwargs)
 
-    return wrapper
+    def decorate(fun):
+        decorated = decorator(wrapper, fun)
+        decorated.many = lambda argslist: cache_many_(
+            ns, timeout, fun, [_full_args(fun, args) for args in argslist],
+            batch=batch)
+        return decorated
+
+    return decorate
 
-def cache_key(ns, timeout, keyfunc):
+def _full_args(fun, args):
+    """Fill in the defaults of `fun' missing from the argument tuple
+    `args', the way the decorated function passes them on, so that
+    ``many'' shares its keys with plain calls."""
+    if not isinstance(args, tuple):
+        args = (args,)
+    names, _, _, defaults = inspect.getargspec(fun)
+    missing = len(names) - len(args)
+    if defaults and 0 < missing <= len(defaults):
+        args += defaults[-missing:]
+    return args
+
+def cache_key(ns, timeout, keyfunc, batch=None, **options):
     """Return a decorator to cache the results of the decorated
     function for the given namespace `ns', keyed by `keyfunc', a
     function that returns a key given the arguments of the decorated
     function."""
     def decorate(fun):
         fun._cache_keyfunc = keyfunc
-        return cache(ns, timeout)(fun)
+        return cache(ns, timeout, batch=batch, **options)(fun)
 
     return decorate
 
 def invalidate_cache_key(ns, key):
     """Invalidates an item in the cache that was made using cache_key for
-    the given namespace `ns', keyed by `key'."""
-    dcache.cache.delete(_mk_key(ns, key))
+    the given namespace `ns', keyed by `key'. Only this process's local
+    copy (if any) is dropped; other processes keep theirs until their
+    `local_timeout' passes."""
+    key = _mk_key(ns, key)
+    local = _config(ns).local
+    if local is not None:
+        local.pop(key, None)
+    dcache.cache.delete(key)
+
+def invalidate_namespace(ns):
+    """Invalidates all items in the cache for the namespace `ns', by
+    bumping its generation. This process sees the new generation
+    immediately, others within GENERATION_TIMEOUT seconds."""
+    key = _generation_key(ns)
+    dcache.cache.add(key, int(time.time()), _generation_backend_timeout)
+    try:
+        dcache.cache.incr(key)
+    except ValueError:
+        # Evicted in the meantime; it will restart from the current
+        # time, which is just as good.
+        pass
+
+    _generations.pop(_generation_local_key(ns), None)
+    local = _config(ns).local
+    if local is not None:
+        local.clear()
@@ -1,7 +1,9 @@
 import hashlib
 import pickle
 
-from util.str import compress_hex
+import util._sym as sym
+from util.storage import Storage
+from util.str import compress_bytes
 
 def pydigest(load):
     """A generic digest function for any python object, by uniqueness
@@ -37,12 +39,106 @@ def pydigest(load):
     
     Simplejson also works, but that also has limitations. None of these work
     perfectly if there is a dictionary involved with arbitrary key ordering.
+    See canonical_digest for one that does.
     """
-    return compress_hex(
-        hashlib.md5(pickle.dumps(load)).hexdigest()
-    )
+    return compress_bytes(hashlib.md5(pickle.dumps(load)).digest())
 
 def pydigest_str(st):
     """A generic digest function for strings only. """
-    return compress_hex(hashlib.md5(st).hexdigest())
+    return compress_bytes(hashlib.md5(st).digest())
 
+def canonical_digest(load):
+    """Like pydigest, but computed from a canonical encoding of `load'
+    for the common types (strings, numbers, None, tuples, lists,
+    dictionaries, sets, Storage and sym), which is both much faster
+    than pickling and the same for equal dictionaries and sets
+    regardless of their ordering. Other types are still pickled."""
+    out = []
+    _encode(load, out)
+    return compress_bytes(hashlib.md5(''.join(out)).digest())
+
+def canonical_str(load):
+    """The canonical encoding of `load' used by canonical_digest."""
+    out = []
+    _encode(load, out)
+    return ''.join(out)
+
+# Every value is encoded as a type tag followed by its contents, with
+# lengths for anything variable, so that no two values share an
+# encoding.
+
+def _encode(obj, out):
+    encoder = _encoders.get(type(obj))
+    if encoder is None:
+        if isinstance(obj, sym.Symbol):
+            encoder = _encode_sym
+        else:
+            encoder = _encode_pickle
+    encoder(obj, out)
+
+def _encode_str(obj, out):
+    out.append('s%d:' % len(obj))
+    out.append(obj)
+
+def _encode_unicode(obj, out):
+    obj = obj.encode('utf-8')
+    out.append('u%d:' % len(obj))
+    out.append(obj)
+
+def _encode_int(obj, out):
+    out.append('i%d;' % obj)
+
+def _encode_bool(obj, out):
+    out.append(obj and 'T' or 'F')
+
+def _encode_float(obj, out):
+    out.append('f%r;' % obj)
+
+def _encode_none(obj, out):
+    out.append('N')
+
+def _encoder_sequence(tag):
+    def encode(obj, out):
+        out.append('%s%d:' % (tag, len(obj)))
+        for item in obj:
+            _encode(item, out)
+    return encode
+
+def _encoder_set(tag):
+    def encode(obj, out):
+        out.append('%s%d:' % (tag, len(obj)))
+        out.extend(sorted(canonical_str(item) for item in obj))
+    return encode
+
+def _encoder_mapping(tag):
+    def encode(obj, out):
+        out.append('%s%d:' % (tag, len(obj)))
+        out.extend(sorted(canonical_str(key) + canonical_str(value)
+                          for key, value in obj.iteritems()))
+    return encode
+
+def _encode_sym(obj, out):
+    name = str(obj)
+    out.append('y%d:' % len(name))
+    out.append(name)
+
+def _encode_pickle(obj, out):
+    obj = pickle.dumps(obj)
+    out.append('p%d:' % len(obj))
+    out.append(obj)
+
+_encoders = {
+    str: _encode_str,
+    unicode: _encode_unicode,
+    int: _encode_int,
+    long: _encode_int,
+    bool: _encode_bool,
+    float: _encode_float,
+    type(None): _encode_none,
+    tuple: _encoder_sequence('t'),
+    list: _encoder_sequence('l'),
+    dict: _encoder_mapping('d'),
+    Storage: _encoder_mapping('S'),
+    set: _encoder_set('e'),
+    frozenset: _encoder_set('z'),
+}
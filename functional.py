@@ -1,14 +1,20 @@
 """fun(ctional) stuff."""
 
+from __future__ import with_statement
+
 import copy
 from decorator import decorator
 import functools
+from itertools import islice
 import os
+import threading
 import types
 import operator
+import weakref
 
 from util import sym
 from util.iter import groupby_safe
+from util.lru import LRU
 
 __all__ = ['flatten', 'flatmap', 'deleted', 'updated', 'switch',
            'wrapgen', 'times', 'mapreduce', 'memoize', 'safe',
@@ -86,10 +92,19 @@ def wrapgen(maybe_gen):
 def times(n, fun):
     return [fun() for _ in xrange(n)]
 
-def mapreduce(mapper, reducer, data):
+def mapreduce(mapper, reducer, data, workers=None, chunksize=1000):
     """A simple mapreduce implementation that takes an input `data' in
     either list or generator form, and outputs a generator with the
-    mapreduced values."""
+    mapreduced values.
+
+    With `workers', the mapper runs over chunks of `chunksize' items
+    in a pool of that many forked processes, and the reducers run in
+    the pool too, over partitions of the keys (by hash). Since the
+    workers are forked, `mapper' and `reducer' needn't be picklable,
+    but the items, keys, values and results must be. The output is
+    unordered either way."""
+    if workers:
+        return _mapreduce_parallel(mapper, reducer, data, workers, chunksize)
 
     mapped = {}
     for item in data:
@@ -98,71 +113,271 @@ def mapreduce(mapper, reducer, data):
 
     return ((key, reducer(key, vals)) for key, vals in mapped.iteritems())
 
-def memoize(fun):
-    def wrapper(fun, *args, **kwargs):
-        if hasattr(fun, '_memoize_keyfunc'):
-            key = fun._memoize_keyfunc(*args, **kwargs)
-        else:
-            key = args, frozenset(kwargs.iteritems())
+def _mapreduce_parallel(mapper, reducer, data, workers, chunksize):
+    # Not imported at the top, since it's rather large.
+    import multiprocessing
 
-        if not key in fun._cache:
+    # More partitions than workers even out the reduces.
+    nparts = 4 * workers
+    pool = multiprocessing.Pool(workers, _mapreduce_init,
+                                (mapper, reducer, nparts))
+    try:
+        def chunks():
+            items = iter(data)
+            while True:
+                chunk = list(islice(items, chunksize))
+                if not chunk:
+                    return
+                yield chunk
+
+        partitions = [{} for _ in xrange(nparts)]
+        for parts in pool.imap_unordered(_mapreduce_map, chunks()):
+            for partition, part in zip(partitions, parts):
+                for key, vals in part.iteritems():
+                    partition.setdefault(key, []).extend(vals)
+
+        for reduced in pool.imap_unordered(_mapreduce_reduce, partitions):
+            for key, result in reduced:
+                yield key, result
+
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+# The mapper, reducer and number of partitions of the mapreduce a
+# worker process was forked for.
+_mapreduce_job = None
+
+def _mapreduce_init(*job):
+    global _mapreduce_job
+    _mapreduce_job = job
+
+def _mapreduce_map(items):
+    mapper, _, nparts = _mapreduce_job
+    parts = [{} for _ in xrange(nparts)]
+    for item in items:
+        for key, val in mapper(item):
+            parts[hash(key) % nparts].setdefault(key, []).append(val)
+
+    return parts
+
+def _mapreduce_reduce(partition):
+    _, reducer, _ = _mapreduce_job
+    return [(key, reducer(key, vals)) for key, vals in partition.iteritems()]
+
+_missing = object()
+
+class _KeyLocks(object):
+    """Locks per key, which exist only while somebody holds or waits
+    for them."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.locks = {}
+
+    def acquire(self, key):
+        with self.lock:
+            entry = self.locks.get(key)
+            if entry is None:
+                entry = self.locks[key] = [threading.RLock(), 0]
+            entry[1] += 1
+        entry[0].acquire()
+
+    def release(self, key):
+        with self.lock:
+            entry = self.locks[key]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.locks[key]
+        entry[0].release()
+
+def _memoize_in(cache, fun, key, args, kwargs, locks=None):
+    value = cache.get(key, _missing)
+    if value is not _missing:
+        return value
+
+    if locks is not None:
+        locks.acquire(key)
+    try:
+        if locks is not None:
+            # Somebody else may have computed it while we waited.
+            value = cache.get(key, _missing)
+        if value is _missing:
             try:
-                fun._cache[key] = fun(*args, **kwargs)
+                value = cache[key] = fun(*args, **kwargs)
             except:
                 # Always invalidate cache on exception.
-                fun._cache.pop(key, None)
+                cache.pop(key, None)
                 raise
+    finally:
+        if locks is not None:
+            locks.release(key)
+
+    return value
+
+def _memoize_cache_factory(maxsize, ttl, weak):
+    if weak:
+        assert maxsize is None and ttl is None, \
+            'weak memoization can not be bounded'
+        return weakref.WeakValueDictionary
+    elif maxsize is not None or ttl is not None:
+        return lambda: LRU(maxsize=maxsize, timeout=ttl)
+    else:
+        return dict
+
+def memoize(fun=None, maxsize=None, ttl=None, weak=False, threadsafe=False):
+    """Memoize `fun'. By default, results are kept forever. Given
+    `maxsize', only that many results are kept, evicting the least
+    recently used. Given `ttl', results are recomputed once they are
+    `ttl' seconds old. With `weak', results are kept only as long as
+    they are referenced elsewhere (so they must be weakly
+    referenceable). With `threadsafe', only one thread at a time
+    computes the result for a given key, while the others wait for it
+    (hits don't lock).
+
+      @memoize
+      def f(x): ...
+
+      @memoize(maxsize=1000, ttl=60)
+      def g(x): ..."""
+    if fun is None:
+        return lambda fun: memoize(fun, maxsize=maxsize, ttl=ttl, weak=weak,
+                                   threadsafe=threadsafe)
 
-        return fun._cache[key]
+    def wrapper(fun, *args, **kwargs):
+        if hasattr(fun, '_memoize_keyfunc'):
+            key = fun._memoize_keyfunc(*args, **kwargs)
+        else:
+            key = args, frozenset(kwargs.iteritems())
 
+        return _memoize_in(fun._cache, fun, key, args, kwargs,
+                           fun._memoize_locks)
+
+    fun._memoize_new_cache = _memoize_cache_factory(maxsize, ttl, weak)
+    fun._memoize_locks = threadsafe and _KeyLocks() or None
     decorated = decorator(wrapper, fun)
     memoize_zap_cache(decorated)
 
     return decorated
 
-def memoize_key(keyfunc):
+def memoize_key(keyfunc, **options):
     def decorate_function(fun):
         fun._memoize_keyfunc = keyfunc
-        return memoize(fun)
+        return memoize(fun, **options)
 
     return decorate_function
 
-def memoize_per_proc(fun):
+def memoize_per_proc(fun=None, **options):
     """Memoize per process."""
     def keyfunc(*args, **kwargs):
         return os.getpid(), args, frozenset(kwargs.iteritems())
 
-    return memoize_key(keyfunc)(fun)
+    if fun is None:
+        return memoize_key(keyfunc, **options)
+    return memoize_key(keyfunc, **options)(fun)
 
 def memoize_zap_cache(fun):
-    fun.undecorated._cache = {}
+    fun = fun.undecorated
+    fun._cache = getattr(fun, '_memoize_new_cache', dict)()
+
+def memoize_persistent(path, version, keyfunc=None):
+    """Memoize the decorated function both in memory and in the file
+    at `path' (see util.memofile), so that results survive the
+    process. A freshly started process only reads the file's index,
+    and unpickles results as they are asked for. `version' (eg. of the
+    code or data computing the results) is part of the key: bump it
+    to ignore all previously stored results. The key is derived from
+    the arguments, or given by `keyfunc', and must be canonically
+    encodable (see util.digest.canonical_str).
+
+      @memoize_persistent('/var/tmp/tables.memo', version=3)
+      def parse_table(name): ..."""
+    from util.memofile import MemoFile
+    store = MemoFile(path)
 
-memoize_cache = {}
-def memoize_(fun, *args, **kwargs):
-    """An inline memoize."""
+    def wrapper(fun, *args, **kwargs):
+        if keyfunc is not None:
+            key = keyfunc(*args, **kwargs)
+        else:
+            key = args, frozenset(kwargs.iteritems())
 
-    key = fun, args, frozenset(kwargs.iteritems())
+        value = fun._cache.get(key, _missing)
+        if value is _missing:
+            stored_key = version, fun.__module__, fun.__name__, key
+            value = store.get(stored_key, _missing)
+            if value is _missing:
+                value = fun(*args, **kwargs)
+                store.put(stored_key, value)
+            fun._cache[key] = value
+
+        return value
+
+    def decorate(fun):
+        decorated = decorator(wrapper, fun)
+        memoize_zap_cache(decorated)
+        return decorated
+
+    return decorate
+
+def memoize_shared(memo=None, keyfunc=None, **options):
+    """Memoize the decorated function in a util.sharedmemo.SharedMemo,
+    `memo' or a new one created with `options', so that processes
+    forked after decoration share the results and compute each of
+    them once. Every hit unpickles the result. The key is derived
+    from the arguments, or given by `keyfunc', and must be canonically
+    encodable (see util.digest.canonical_str).
+
+      @memoize_shared(size=256 << 20)
+      def lookup_table(name): ..."""
+    # Not imported at the top, since it pulls in multiprocessing.
+    from util.sharedmemo import SharedMemo
+    if memo is None:
+        memo = SharedMemo(**options)
 
-    if not key in memoize_cache:
-        try:
-            memoize_cache[key] = fun(*args, **kwargs)
-        except:
-            # Always invalidate cache on exception.
-            memoize_cache.pop(key, None)
-            raise
+    def wrapper(fun, *args, **kwargs):
+        if keyfunc is not None:
+            key = keyfunc(*args, **kwargs)
+        else:
+            key = args, frozenset(kwargs.iteritems())
+
+        return memo.get((fun.__module__, fun.__name__, key),
+                        fun, *args, **kwargs)
 
-    return memoize_cache[key]
+    return lambda fun: decorator(wrapper, fun)
+
+MEMOIZE_CACHE_SIZE = 10000
+memoize_cache = LRU(maxsize=MEMOIZE_CACHE_SIZE)
+def memoize_(fun, *args, **kwargs):
+    """An inline memoize. Only the MEMOIZE_CACHE_SIZE most recently
+    used results are kept."""
+    key = fun, args, frozenset(kwargs.iteritems())
+    return _memoize_in(memoize_cache, fun, key, args, kwargs)
+
+singleton_cache = {}
+_singleton_locks = _KeyLocks()
+def singleton_(fun, *args, **kwargs):
+    """An inline singleton: `fun' is called only once for the given
+    arguments, even across threads."""
+    key = fun, args, frozenset(kwargs.iteritems())
+    return _memoize_in(singleton_cache, fun, key, args, kwargs,
+                       _singleton_locks)
 
 # We name "singleton" versions of memoize, too, in order to
 # distinguish between the usage of memoize as a caching mechanism (as
 # in true memoization) and usage where correctness relies on the
-# underlying function being called ones (singletons). Right now they
-# are equivalent, but it's possible and indeed likely that in the
-# future the "memoize" variants will store weakrefs as to allow them
-# to be garbage collected aggressively.
-singleton, singleton_key, singleton_per_proc, singleton_ = (
-    memoize, memoize_key, memoize_per_proc, memoize_
-)
+# underlying function being called once (singletons). Singletons are
+# therefore thread safe, and never bounded (with `maxsize', `ttl' or
+# `weak'); the inline memoize_ is bounded, so singleton_ has a
+# separate cache.
+def singleton(fun):
+    return memoize(fun, threadsafe=True)
+
+def singleton_key(keyfunc):
+    return memoize_key(keyfunc, threadsafe=True)
+
+def singleton_per_proc(fun):
+    return memoize_per_proc(fun, threadsafe=True)
 
 def memoizei(meth):
     """A version of memoize that caches data on an *instance* (we
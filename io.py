@@ -1,5 +1,9 @@
 """Various I/O utilities."""
 
+import os
+import stat
+import mmap
+
 class GeneratorFile(object):
     """Provides a limited virtual file interface (only read()) where
     the contents is streamed (and buffered) as needed via generator."""
@@ -117,3 +121,92 @@ class GeneratorFile(object):
 
     def write(self, *args):
         assert False, 'Not supported!'
+
+class RecordReader(object):
+    """Reads file `f' in chunks, fixed size records or delimited
+    records. Regular files are read through mmap; others through a
+    buffer of (at least) `buffer_size' bytes, so that each record is
+    copied out once instead of the buffer being resliced for every
+    record."""
+    def __init__(self, f, buffer_size=1 << 16):
+        self.f           = f
+        self.buffer_size = buffer_size
+        self.buffer      = ''
+        self.pos         = 0
+        self.eof         = False
+        self.map         = None
+
+        try:
+            fd    = f.fileno()
+            st    = os.fstat(fd)
+            start = f.tell()
+        except (AttributeError, IOError, OSError):
+            return
+
+        if stat.S_ISREG(st.st_mode) and st.st_size > start:
+            self.map    = mmap.mmap(fd, st.st_size, mmap.MAP_SHARED,
+                                    mmap.PROT_READ)
+            self.buffer = self.map
+            self.pos    = start
+            self.eof    = True
+
+    def _fill(self, howmuch):
+        """Read at least `howmuch' more bytes into the buffer, dropping
+        what's been consumed. Returns False at EOF."""
+        if self.eof:
+            return False
+
+        chunk = self.f.read(max(howmuch, self.buffer_size))
+        if not chunk:
+            self.eof = True
+            return False
+
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos    = 0
+        return True
+
+    def read(self, n):
+        """Returns the next `n' bytes, or fewer at EOF."""
+        while len(self.buffer) - self.pos < n:
+            if not self._fill(n - (len(self.buffer) - self.pos)):
+                break
+
+        this      = self.buffer[self.pos:self.pos + n]
+        self.pos += len(this)
+        return this
+
+    def chunks(self):
+        """Yields the rest of the file in chunks of up to
+        `buffer_size' bytes."""
+        while True:
+            this = self.read(self.buffer_size)
+            if not this:
+                return
+            yield this
+
+    def split(self, delim):
+        """Yields the non-empty records separated by `delim', including
+        a final one not followed by it."""
+        start = self.pos
+        while True:
+            end = self.buffer.find(delim, start)
+            if end < 0:
+                # Only search the new data next time (the buffer is
+                # rebased to self.pos).
+                start = max(self.pos, len(self.buffer) - len(delim) + 1)
+                start -= self.pos
+                if not self._fill(self.buffer_size):
+                    if self.pos < len(self.buffer):
+                        yield self.read(len(self.buffer) - self.pos)
+                    return
+            else:
+                if end > self.pos:
+                    yield self.buffer[self.pos:end]
+                self.pos = start = end + len(delim)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.buffer = ''
+        self.pos    = 0
@@ -0,0 +1,140 @@
+"""A bounded, thread safe LRU mapping with optional entry expiry."""
+
+from __future__ import with_statement
+
+import threading
+import time
+
+__all__ = ['LRU']
+
+# Links in the recency list are lists of:
+_PREV, _NEXT, _KEY, _VALUE, _SIZE, _EXPIRES = range(6)
+
+_missing = object()
+
+class LRU(object):
+    """A mapping holding at most `maxsize' entries and, if `maxbytes'
+    is given, at most `maxbytes' bytes as measured by `sizeof'. The
+    least recently used entries are evicted first. Entries set with a
+    `timeout' (in seconds) read as missing once it has passed. All
+    operations are O(1).
+
+      lru = LRU(maxsize=2)
+      lru['a'] = 1
+      lru['b'] = 2
+      lru['a']      # 'a' is now the most recently used
+      lru['c'] = 3  # evicts 'b'"""
+
+    def __init__(self, maxsize=None, maxbytes=None, sizeof=len,
+                 timeout=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.timeout = timeout
+        self.bytes = 0
+
+        self._lock = threading.Lock()
+        self._map = {}
+        # Circular doubly linked list; root[_NEXT] is the least
+        # recently used entry and root[_PREV] the most recently used.
+        self._root = root = []
+        root[:] = [root, root, None, None, 0, None]
+
+    def get(self, key, default=None):
+        with self._lock:
+            link = self._map.get(key)
+            if link is None:
+                return default
+            if link[_EXPIRES] is not None and link[_EXPIRES] <= time.time():
+                self._unlink(link)
+                return default
+
+            self._unlink_list(link)
+            self._link_last(link)
+            return link[_VALUE]
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        expires = None if timeout is None else time.time() + timeout
+        size = 0 if self.maxbytes is None else self.sizeof(value)
+
+        with self._lock:
+            link = self._map.get(key)
+            if link is not None:
+                self._unlink(link)
+
+            if self.maxbytes is not None and size > self.maxbytes:
+                # It would only evict everything else.
+                return
+
+            link = [None, None, key, value, size, expires]
+            self._map[key] = link
+            self._link_last(link)
+            self.bytes += size
+
+            root = self._root
+            while ((self.maxsize is not None and
+                    len(self._map) > self.maxsize) or
+                   (self.maxbytes is not None and
+                    self.bytes > self.maxbytes)):
+                self._unlink(root[_NEXT])
+
+    def pop(self, key, default=_missing):
+        with self._lock:
+            link = self._map.get(key)
+            if link is not None:
+                self._unlink(link)
+                if (link[_EXPIRES] is None or
+                    link[_EXPIRES] > time.time()):
+                    return link[_VALUE]
+
+        if default is _missing:
+            raise KeyError(key)
+        return default
+
+    def clear(self):
+        with self._lock:
+            self._map.clear()
+            root = self._root
+            root[:] = [root, root, None, None, 0, None]
+            self.bytes = 0
+
+    def __getitem__(self, key):
+        value = self.get(key, _missing)
+        if value is _missing:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        self.pop(key)
+
+    def __contains__(self, key):
+        return self.get(key, _missing) is not _missing
+
+    def __len__(self):
+        return len(self._map)
+
+    def __repr__(self):
+        return '<LRU %d/%s entries, %d/%s bytes>' % (
+            len(self), self.maxsize, self.bytes, self.maxbytes)
+
+    # These expect self._lock to be held.
+
+    def _link_last(self, link):
+        root = self._root
+        last = root[_PREV]
+        link[_PREV], link[_NEXT] = last, root
+        last[_NEXT] = root[_PREV] = link
+
+    def _unlink_list(self, link):
+        prev, next = link[_PREV], link[_NEXT]
+        prev[_NEXT], next[_PREV] = next, prev
+
+    def _unlink(self, link):
+        self._unlink_list(link)
+        del self._map[link[_KEY]]
+        self.bytes -= link[_SIZE]
@@ -1,7 +1,9 @@
 """A slightly more complex mapreduce implementation (though it retains
 the interface) than util.functional.mapreduce. This one will page to
-disk if necessary, and can serve as an eventual interface to other MR
-implementations (eg. Disco).
+disk if necessary (in sorted runs that are merged when reducing), and
+serves as an interface to other MR implementations (eg. Disco) through
+Backends; see mapreduce_cluster for one running jobs on local worker
+processes.
 
 This one enforces string types on input and output. TODO(marius):
 perhaps we can integrate JSON support so we get at least *some* python
@@ -13,143 +15,418 @@ overrideable by invocation parameters.
   mapreduce:
     mem_limit_mb - the number of megabytes of allowed memory usage"""
 
-import sys
-import os
+from __future__ import with_statement
 
+import time
+import threading
+
+import zlib
+import heapq
+import struct
 import tempfile
-import subprocess
 import cPickle
-import base64
-from itertools import imap, groupby
+from itertools import imap, groupby, count
+from contextlib import contextmanager
 from decorator import decorator
 
 from environment import env
 from util import *
 from util.functional import mk_item_picker, switch
+from util.io import RecordReader
 
 log = mixlog()
 
 def chunkiter(f):
+    return RecordReader(f).chunks()
+
+def delim_reader(f, delim):
+    return RecordReader(f).split(delim)
+
+def mapreduce(mapper, reducer, data, mem_limit_mb=sym.env, combiner=None,
+              counters=None, progress=None, progress_interval=10,
+              backend=None):
+    """Map `data' with `mapper' and reduce each key's values with
+    `reducer'. If given, ``combiner(key, values)'' combines some of
+    the values mapped to a key into one value, which must be valid
+    reducer (and combiner) input; it's applied to the mapped data
+    before spilling it to disk and while merging spills, so
+    associative reducers (counts, sums) spill much less.
+
+    The job's Counters (see `increment') are kept in `counters', if
+    given, and are final once the output is exhausted. `progress', if
+    given, is called with them every `progress_interval' seconds or
+    so, and once the job is done.
+
+    The job runs in this process, unless a `backend' (see Backend) is
+    given to run it."""
+    job = Job(mapper, reducer, data, mem_limit_mb=mem_limit_mb,
+              combiner=combiner, counters=counters, progress=progress,
+              progress_interval=progress_interval)
+    if backend is not None:
+        return backend.run(job)
+
+    # Whenever the mapped data reaches the memory limit, it's sorted
+    # and spilled to a run file; the reduce then merges the runs. Once
+    # we've spilled, keys are strings.
+    buffer = _MapBuffer(job)
+    buffer.map(data)
+
+    [mapped], [runs] = buffer.mapped, buffer.runs
+    if runs:
+        if mapped:
+            buffer.spill()
+        log.info('Reducing from %d runs', len(runs))
+        sorted_output = runs.merge()
+    else:
+        with job.timing('sort_seconds'):
+            mapped.sort(key=lambda x: x[0])
+        sorted_output = mapped
+
+    return _reduce(job, sorted_output)
+
+def _reduce(job, sorted_output, finish=True):
+    counters = job.counters
+    output = ((key, imap(mk_item_picker(1), vals))
+              for key, vals in groupby(sorted_output, lambda kv: kv[0]))
+
     while True:
-        chunk = f.read(8192)
-        if len(chunk) == 0:
-            return
+        with job:
+            # Merging spills happens as we go through the output.
+            with job.timing('sort_seconds'):
+                try:
+                    key, vals = output.next()
+                except StopIteration:
+                    break
+
+            with job.timing('reduce_seconds'):
+                result = job.reducer(key, vals)
+            counters['records_out'] += 1
+            job.tick()
+
+        yield key, result
+
+    if finish:
+        job.finish()
+
+class _MapBuffer(object):
+    """The map output of a job, in `partitions' partitions (see
+    `partition'), each spilled to sorted runs whenever the buffer
+    reaches the job's memory limit."""
+
+    def __init__(self, job, partitions=1):
+        self.job = job
+        self.sizeof = job.sizer()
+        self.mapped = [[] for _ in xrange(partitions)]
+        self.runs = [job.spill_runs() for _ in xrange(partitions)]
+        self.bytes = 0
+
+    def map(self, items):
+        job, counters = self.job, self.job.counters
+        mapper, sizeof, mapped = job.mapper, self.sizeof, self.mapped
+        partitions = len(mapped)
+
+        with job:
+            begin, sort_seconds = time.time(), counters['sort_seconds']
+
+            for item in items:
+                counters['records_in'] += 1
+                for key, val in mapper(item):
+                    if partitions == 1:
+                        mapped[0].append((key, val))
+                    else:
+                        key = str(key)
+                        mapped[partition(key, partitions)].append((key, val))
+
+                    size = sizeof(val)
+                    self.bytes += size
+                    counters['records_mapped'] += 1
+                    counters['bytes_mapped'] += size
+
+                    if self.bytes >= job.limit_bytes:
+                        self.spill()
+
+                job.tick()
+
+            counters['map_seconds'] += (
+                time.time() - begin -
+                (counters['sort_seconds'] - sort_seconds))
+
+    def spill(self):
+        job = self.job
+        if not any(self.runs):
+            log.info('Switching to disk sorting... mapping %d bytes',
+                     self.bytes)
+
+        with job:
+            with job.timing('sort_seconds'):
+                for mapped, runs in zip(self.mapped, self.runs):
+                    if mapped:
+                        runs.spill(mapped)
+                        del mapped[:]
+
+        job.counters['spills'] += 1
+        self.bytes = 0
+
+def partition(key, partitions):
+    """The partition (of `partitions') that map output with the
+    (string) `key' goes to."""
+    return (zlib.crc32(key) & 0xffffffff) % partitions
+
+class Backend(object):
+    """Runs mapreduce Jobs somewhere else than in the calling process
+    (see mapreduce_cluster.LocalCluster). run() submits the job, has
+    its map output shuffled into partitions that are each reduced in
+    one place, and collects the reduced output."""
+
+    def run(self, job):
+        handle = self.submit(job)
+        self.shuffle(handle)
+        return self.collect(handle)
+
+    def submit(self, job):
+        """Start mapping `job' (a Job), returning a handle for it."""
+        raise NotImplementedError
+
+    def shuffle(self, handle):
+        """Once the job is mapped, bring each partition of the map
+        output together and reduce it."""
+        raise NotImplementedError
+
+    def collect(self, handle):
+        """Return an iterator of the (key, reduced value) output of
+        the job, sorted by key; the job's counters are final once it's
+        exhausted."""
+        raise NotImplementedError
+
+class Counters(dict):
+    """Named job counters, all starting at 0. Built in are
+    records_in, records_mapped, records_out, bytes_mapped, spills
+    and map_seconds, sort_seconds and reduce_seconds (time spent
+    mapping, sorting and merging, and reducing)."""
+
+    builtin = ['records_in', 'records_mapped', 'records_out',
+               'bytes_mapped', 'spills',
+               'map_seconds', 'sort_seconds', 'reduce_seconds']
+
+    def __init__(self, *args, **kwargs):
+        super(Counters, self).__init__(*args, **kwargs)
+        for name in self.builtin:
+            self.setdefault(name, 0)
+
+    def __missing__(self, name):
+        return 0
+
+    def increment(self, name, n=1):
+        self[name] += n
+
+_current = threading.local()
+
+def increment(name, n=1):
+    """Increment counter `name' of the mapreduce whose mapper,
+    reducer or combiner is running; this does nothing outside of
+    mapreduces."""
+    counters = getattr(_current, 'counters', None)
+    if counters is not None:
+        counters.increment(name, n)
+
+class Job(object):
+    """A mapreduce job (see mapreduce for the arguments), as run by
+    Backends. It keeps the job's counters and reports its progress;
+    the job is current (for `increment') within a with statement."""
+
+    def __init__(self, mapper, reducer, data, mem_limit_mb=sym.env,
+                 combiner=None, counters=None, progress=None,
+                 progress_interval=10):
+        mem_limit_mb = switch(mem_limit_mb,
+                              env=env.mapreduce.mem_limit_mb,
+                              _=mem_limit_mb)
+        if counters is None:
+            counters = Counters()
+
+        self.mapper = mapper
+        self.reducer = reducer
+        self.data = data
+        self.limit_bytes = mem_limit_mb << 20
+        self.combiner = combiner
+        self.counters = counters
+        self.progress = progress
+        self.progress_interval = progress_interval
+        self.next_progress = time.time() + progress_interval
+        self.outer = []
+
+        # Map output that needs serialization is kept as is in memory,
+        # and only serialized when spilled, so in-memory mapreduces
+        # never pay for it.
+        if getattr(mapper, 'needs_serialization', False):
+            assert reducer.needs_serialization
+            self.encode, self.decode = serialize_obj, deserialize_str
         else:
-            yield chunk
+            self.encode = self.decode = None
 
-def delim_reader(f, delim):
-    content = ''
-    for chunk in chunkiter(f):
-        content += chunk
+    def spill_runs(self):
+        return _SpillRuns(self.combiner, self.encode, self.decode)
+
+    def sizer(self):
+        """A function giving the size map output values are accounted
+        for by: their (estimated) encoded size."""
+        if self.encode is None:
+            return len
+        return _EncodedSize(self.encode)
+
+    def __enter__(self):
+        self.outer.append(getattr(_current, 'counters', None))
+        _current.counters = self.counters
+
+    def __exit__(self, *_):
+        _current.counters = self.outer.pop()
+
+    @contextmanager
+    def timing(self, name):
+        begin = time.time()
+        try:
+            yield
+        finally:
+            self.counters[name] += time.time() - begin
+
+    def tick(self):
+        if self.progress is not None and time.time() >= self.next_progress:
+            self.progress(self.counters)
+            self.next_progress = time.time() + self.progress_interval
+
+    def finish(self):
+        log.info('mapreduce done: %s', ', '.join(
+            '%s=%s' % kv for kv in sorted(self.counters.iteritems())))
+        if self.progress is not None:
+            self.progress(self.counters)
+
+# Spill run records: key length, value length, key, value.
+_record_header = struct.Struct('<II')
+
+# The most runs we merge at once; more are merged in levels.
+SPILL_FANIN = 64
 
+def _write_run(records, f=None):
+    if f is None:
+        f = tempfile.TemporaryFile()
+    pack = _record_header.pack
+    for key, value in records:
+        f.write(pack(len(key), len(value)))
+        f.write(key)
+        f.write(value)
+    f.seek(0)
+    return f
+
+def _read_run(f):
+    reader = RecordReader(f)
+    read = reader.read
+    unpack, size = _record_header.unpack, _record_header.size
+    try:
         while True:
-            pos = content.find(delim)
-            if pos < 0:
+            header = read(size)
+            if not header:
+                return
+            klen, vlen = unpack(header)
+            yield read(klen), read(vlen)
+    finally:
+        reader.close()
+        f.close()
+
+class _SpillRuns(object):
+    """Sorted runs of (key, value) records in anonymous temporary
+    files, merged in levels of at most SPILL_FANIN runs so that we
+    never hold too many files open. Values are written with `encode'
+    and read with `decode', if given, and combined with `combiner', if
+    given, whenever they're written."""
+
+    def __init__(self, combiner=None, encode=None, decode=None):
+        self.combiner = combiner
+        self.encode = encode
+        self.decode = decode
+        self.levels = []
+
+    def spill(self, records):
+        """Sort `records' by (stringified) key and write them as a new
+        run."""
+        records = [(str(k), v) for k, v in records]
+        records.sort(key=lambda x: x[0])
+        run = _write_run(self._map(self.encode, self._combine(records)))
+
+        for level in count():
+            if level == len(self.levels):
+                self.levels.append([])
+            self.levels[level].append(run)
+            if len(self.levels[level]) < SPILL_FANIN:
                 break
-            elif pos == 0:
-                content = content[1:]
-                continue
-
-            yield content[:pos]
-            content = content[pos:]
-
-def make_mapper_reducer(mapper, reducer):
-    """Processes `mapper' and `reducer', adding serialization to map
-    output and reduce input. This is not required for in-memory
-    mapreduces that allow passing non-string python values between the
-    mapper & reducer."""
-    if getattr(mapper, 'needs_serialization', False):
-        assert reducer.needs_serialization
-        mapper = lambda x, M=mapper: ((k, serialize_obj(v)) for k, v in M(x))
-        reducer = lambda k, vs, R=reducer: R(k, map(deserialize_str, vs))
-    return mapper, reducer
-
-def mapreduce(mapper, reducer, data, mem_limit_mb=sym.env):
-    mem_limit_mb = switch(mem_limit_mb,
-                          env=env.mapreduce.mem_limit_mb,
-                          _=mem_limit_mb)
-
-    limit_bytes = mem_limit_mb << 20
-    bytes = 0
-
-    # TODO: for purely in-memory mapreduces, we could optimize away
-    # the serialization/deserialization.
-    mapper, reducer = make_mapper_reducer(mapper, reducer)
-
-    mapped = []
-    map_map = lambda key, val: mapped.append((key, val))
-    map_sort = lambda: mapped.sort(key=lambda x: x[0])
-    map_output = lambda: mapped
-    def map_cleanup():
-        del mapped[:]
-
-    for item in data:
-        for key, val in mapper(item):
-            if bytes >= limit_bytes:
-                tmpfile = tempfile.NamedTemporaryFile()
-                outfile = tempfile.NamedTemporaryFile()
-                def map_map(key, value):
-                    key = str(key)
-                    # This is a bit of an artifical limitation - it
-                    # would be easy to devise an escaping scheme, but
-                    # whoever runs into this first gets to fix it!!
-                    assert '|' not in key, (
-                        '| are not allowed in keys for disk sorting'
-                    )
-                    assert '\0' not in value, (
-                        'null-bytes are not allowed in values '
-                        'for disk sorting'
-                    )
-                    tmpfile.write("%s|%s\0" % (key, value))
-
-                log.info('Switching to disk sorting... mapping %d bytes',
-                         bytes)
-                map(lambda kv: map_map(kv[0], kv[1]), map_output())
-                map_cleanup()
-
-                def map_sort():
-                    tmpfile.flush()
-                    p = subprocess.Popen(['sort',
-                                          '-k', '1,1',   # key at pos 1
-                                          '-z',          # nul-termination
-                                          '-t', '|',     # |-separated
-                                          '-o', outfile.name,
-                                          tmpfile.name])
-
-                    if p.wait():
-                        raise sym.external_sort_failed
-
-                def map_output():
-                    f = open(outfile.name)
-                    log.info('Reducing from %s', outfile.name)
-                    return imap(lambda kv: kv.split('|', 1),
-                                delim_reader(f, '\0'))
-
-                def map_cleanup():
-                    # Files get removed once their NamedTemporaryFile
-                    # objects get GCd
-                    pass
-
-                # hack to disable doing this conversion more than
-                # once.
-                limit_bytes = sys.maxint
-
-            map_map(key, val)
-            bytes += len(val)
-
-    map_sort()
 
-    output = ((key, imap(mk_item_picker(1), vals))
-              for key, vals in groupby(map_output(), lambda kv: kv[0]))
+            run = _write_run(self._merge_encoded(self.levels[level]))
+            self.levels[level] = []
+
+    def add(self, run):
+        """Add the sorted run in file `run' (eg. as written by
+        write())."""
+        if not self.levels:
+            self.levels.append([])
+        self.levels[0].append(run)
+
+    def write(self, f):
+        """Merge all runs into file `f'. This consumes the runs."""
+        runs = [run for level in self.levels for run in level]
+        self.levels = []
+        _write_run(self._merge_encoded(runs), f)
+
+    def merge(self):
+        """Stream all records, sorted by key. This consumes the
+        runs."""
+        runs = [run for level in self.levels for run in level]
+        self.levels = []
+        return self._combine(self._map(self.decode, _merge_runs(runs)))
+
+    def _merge_encoded(self, runs):
+        merged = _merge_runs(runs)
+        if self.combiner is None:
+            return merged
+        return self._map(self.encode, self._combine(
+            self._map(self.decode, merged)))
+
+    def _combine(self, records):
+        if self.combiner is None:
+            return records
+        return ((key, self.combiner(key, imap(mk_item_picker(1), vals)))
+                for key, vals in groupby(records, lambda kv: kv[0]))
+
+    def _map(self, fun, records):
+        if fun is None:
+            return records
+        return ((key, fun(value)) for key, value in records)
+
+    def __len__(self):
+        return sum(map(len, self.levels))
+
+def _merge_runs(runs):
+    return heapq.merge(*map(_read_run, runs))
+
+class _EncodedSize(object):
+    """Estimates the size values would be encoded to by `encode',
+    from a sample of them."""
+
+    SAMPLE = 64
+
+    def __init__(self, encode):
+        self.encode = encode
+        self.count = self.sampled = self.total = 0
 
-    return ((key, reducer(key, vals))
-            for key, vals in output)
+    def __call__(self, value):
+        self.count += 1
+        if self.sampled < self.SAMPLE or self.count % self.SAMPLE == 0:
+            self.sampled += 1
+            self.total += len(self.encode(value))
+        return self.total // self.sampled
 
 def serialize_obj(obj):
-    return base64.b64encode(cPickle.dumps(obj))
+    return cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL)
 
 def deserialize_str(str):
-    return cPickle.loads(base64.b64decode(str))
+    return cPickle.loads(str)
 
 def serialize(mapper):
     """Serialize the map output. This retains Python objects across
@@ -0,0 +1,241 @@
+"""A util.mapreduce Backend running jobs on a local "cluster" of
+forked worker processes. The workers talk to the coordinating process
+over a Unix socket, and exchange map output as sorted run files in a
+shared directory:
+
+  - The coordinator hands out chunks of the input to idle workers,
+    which map them into one buffer per partition (there's a partition
+    per worker), spilling as they reach the memory limit.
+  - Once the input is exhausted, each worker merges each partition of
+    its map output into one file.
+  - Worker i merges and reduces partition i from every worker's files
+    into an output file.
+  - The coordinator merges the output files.
+
+Workers are forked, so mappers, reducers and combiners needn't be
+picklable, but input items are sent to the workers, and reduced values
+back, so those must be.
+
+  for key, value in mapreduce(mapper, reducer, data,
+                              backend=LocalCluster(workers=8)):
+      ..."""
+
+from __future__ import with_statement
+
+import os
+import heapq
+import select
+import shutil
+import cPickle
+import tempfile
+import traceback
+import multiprocessing
+from itertools import islice
+from multiprocessing.connection import Listener, Client
+
+from util import *
+from util.mapreduce import (Backend, Counters, _MapBuffer, _reduce,
+                            _read_run, _write_run)
+
+__all__ = ['LocalCluster']
+
+log = mixlog()
+
+class LocalCluster(Backend):
+    """Runs jobs on `workers' (by default, one per CPU) worker
+    processes, sending them the input in chunks of `chunksize' items.
+    Spill and output files go in a directory under `tmpdir'."""
+
+    def __init__(self, workers=None, chunksize=1000, tmpdir=None):
+        self.workers = workers or multiprocessing.cpu_count()
+        self.chunksize = chunksize
+        self.tmpdir = tmpdir
+
+    def submit(self, job):
+        run = _ClusterRun(job, self.workers, self.tmpdir)
+        try:
+            run.start()
+            run.map(self.chunksize)
+        except:
+            run.abort()
+            raise
+        return run
+
+    def shuffle(self, run):
+        try:
+            run.reduce()
+        except:
+            run.abort()
+            raise
+
+    def collect(self, run):
+        return run.collect()
+
+class _ClusterRun(object):
+    """The coordinator's side of a job running on a LocalCluster."""
+
+    def __init__(self, job, workers, tmpdir):
+        self.job = job
+        self.workers = workers
+        self.tmpdir = tmpdir
+        self.procs = []
+        self.conns = []
+        self.counters = [{} for _ in xrange(workers)]
+        self.partitions = [[] for _ in xrange(workers)]
+        self.outputs = []
+
+    def start(self):
+        self.directory = tempfile.mkdtemp(prefix='mapreduce', dir=self.tmpdir)
+        authkey = os.urandom(16)
+        listener = Listener(os.path.join(self.directory, 'socket'),
+                            'AF_UNIX', authkey=authkey)
+        try:
+            for i in xrange(self.workers):
+                proc = multiprocessing.Process(
+                    target=_worker,
+                    args=(self.job, i, self.workers, listener.address,
+                          authkey, self.directory))
+                proc.daemon = True
+                proc.start()
+                self.procs.append(proc)
+
+            self.conns = [None] * self.workers
+            for _ in xrange(self.workers):
+                conn = listener.accept()
+                self.conns[conn.recv()] = conn
+        finally:
+            listener.close()
+
+    def map(self, chunksize):
+        data = iter(self.job.data)
+        idle, busy = list(self.conns), {}
+        while True:
+            chunk = list(islice(data, chunksize))
+            if not chunk:
+                break
+
+            if not idle:
+                idle.append(self._wait(busy))
+            conn = idle.pop()
+            conn.send(('map', chunk))
+            busy[conn.fileno()] = conn
+
+        while busy:
+            self._wait(busy)
+
+        for conn in self.conns:
+            conn.send(('flush',))
+        for conn in self.conns:
+            for i, path in self._recv(conn).iteritems():
+                self.partitions[i].append(path)
+
+    def reduce(self):
+        for i, conn in enumerate(self.conns):
+            conn.send(('reduce', i, self.partitions[i]))
+        for conn in self.conns:
+            self.outputs.append(self._recv(conn))
+
+        for conn in self.conns:
+            conn.send(('stop',))
+            conn.close()
+        for proc in self.procs:
+            proc.join()
+
+    def collect(self):
+        try:
+            runs = [_read_run(open(path, 'rb')) for path in self.outputs]
+            for key, value in heapq.merge(*runs):
+                yield key, cPickle.loads(value)
+        finally:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+        self.job.finish()
+
+    def abort(self):
+        for conn in self.conns:
+            if conn is not None:
+                conn.close()
+        for proc in self.procs:
+            if proc.is_alive():
+                proc.terminate()
+            proc.join()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _wait(self, busy):
+        """Wait for one of the `busy' workers' replies, returning its
+        connection."""
+        ready, _, _ = select.select(busy.keys(), [], [])
+        conn = busy.pop(ready[0])
+        self._recv(conn)
+        return conn
+
+    def _recv(self, conn):
+        i = self.conns.index(conn)
+        try:
+            reply = conn.recv()
+        except EOFError:
+            raise sym.mapreduce_worker_failed.exc('worker %d died' % i)
+
+        if reply[0] == 'error':
+            raise sym.mapreduce_worker_failed.exc(reply[1])
+
+        _, self.counters[i], result = reply
+        counters = self.job.counters
+        for name in set(counters) | set().union(*self.counters):
+            counters[name] = sum(c.get(name, 0) for c in self.counters)
+        self.job.tick()
+
+        return result
+
+def _worker(job, me, partitions, address, authkey, directory):
+    conn = Client(address, 'AF_UNIX', authkey=authkey)
+    conn.send(me)
+
+    job.counters = Counters()
+    job.progress = None
+    buffer = _MapBuffer(job, partitions)
+
+    def map_chunk(items):
+        buffer.map(items)
+
+    def flush():
+        if any(buffer.mapped):
+            buffer.spill()
+
+        paths = {}
+        with job:
+            for i, runs in enumerate(buffer.runs):
+                if runs:
+                    paths[i] = os.path.join(directory, 'map-%d-%d' % (me, i))
+                    with open(paths[i], 'wb') as f:
+                        runs.write(f)
+        return paths
+
+    def reduce_partition(i, paths):
+        runs = job.spill_runs()
+        for path in paths:
+            runs.add(open(path, 'rb'))
+
+        output = os.path.join(directory, 'output-%d' % i)
+        with open(output, 'wb') as f:
+            _write_run(((key, cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL))
+                        for key, value in _reduce(job, runs.merge(),
+                                                  finish=False)), f)
+        return output
+
+    commands = {'map': map_chunk, 'flush': flush,
+                'reduce': reduce_partition}
+    while True:
+        message = conn.recv()
+        if message[0] == 'stop':
+            break
+
+        try:
+            result = commands[message[0]](*message[1:])
+        except Exception:
+            conn.send(('error', traceback.format_exc()))
+            break
+
+        conn.send(('ok', dict(job.counters), result))
+
+    conn.close()
@@ -0,0 +1,140 @@
+"""An append-only file of pickled values, keyed by the digests of
+their (canonically encoded) keys, and read through mmap. This backs
+util.functional.memoize_persistent.
+
+The file is a sequence of records, each a header (magic, 16 byte MD5
+digest of the key, length of the value) followed by the pickled value.
+Opening a file only walks the headers to build an index; values are
+unpickled when they are looked up. Appends are serialized across
+processes with flock, and a torn record left by a crashed writer is
+truncated away by the next writer."""
+
+from __future__ import with_statement
+
+import os
+import mmap
+import fcntl
+import struct
+import hashlib
+import cPickle
+import threading
+
+from util.digest import canonical_str
+
+__all__ = ['MemoFile']
+
+_header = struct.Struct('<4s16sI')
+_magic = 'MEMO'
+
+def _digest(key):
+    return hashlib.md5(canonical_str(key)).digest()
+
+class MemoFile(object):
+    """A persistent mapping of keys (see util.digest.canonical_str) to
+    picklable values at `path'. Entries can't be removed or replaced;
+    include a version in the keys instead."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.pid = None
+
+    def get(self, key, default=None):
+        digest = _digest(key)
+        with self.lock:
+            self._check_open()
+            location = self.index.get(digest)
+            if location is None:
+                # Maybe another process has added it.
+                self._scan()
+                location = self.index.get(digest)
+                if location is None:
+                    return default
+
+            start, length = location
+            data = self.map[start:start + length]
+
+        return cPickle.loads(data)
+
+    def put(self, key, value):
+        digest = _digest(key)
+        data = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+        record = _header.pack(_magic, digest, len(data)) + data
+
+        with self.lock:
+            self._check_open()
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                self._scan()
+                if digest in self.index:
+                    return
+                if os.fstat(self.fd).st_size > self.end:
+                    # Nobody else is writing, so this is a torn record.
+                    os.ftruncate(self.fd, self.end)
+
+                while record:
+                    record = record[os.write(self.fd, record):]
+                self._scan()
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def __contains__(self, key):
+        digest = _digest(key)
+        with self.lock:
+            self._check_open()
+            if digest not in self.index:
+                self._scan()
+            return digest in self.index
+
+    def __len__(self):
+        with self.lock:
+            self._check_open()
+            self._scan()
+            return len(self.index)
+
+    def close(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                if self.map is not None:
+                    self.map.close()
+                os.close(self.fd)
+            self.pid = None
+
+    # These expect self.lock to be held.
+
+    def _check_open(self):
+        # Forked children need their own descriptor: flock locks
+        # belong to open files, which are shared across fork.
+        if self.pid == os.getpid():
+            return
+
+        self.pid = os.getpid()
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_APPEND,
+                          0644)
+        self.map = None
+        self.end = 0
+        self.index = {}
+        self._scan()
+
+    def _scan(self):
+        """Index the records added since the last scan."""
+        size = os.fstat(self.fd).st_size
+        if size <= self.end:
+            return
+
+        if self.map is not None:
+            self.map.close()
+        self.map = mmap.mmap(self.fd, size, mmap.MAP_SHARED, mmap.PROT_READ)
+
+        offset = self.end
+        while offset + _header.size <= size:
+            magic, digest, length = _header.unpack_from(self.map, offset)
+            start = offset + _header.size
+            if magic != _magic or start + length > size:
+                # Being written, or torn.
+                break
+
+            self.index[digest] = start, length
+            offset = start + length
+
+        self.end = offset
@@ -1,14 +1,24 @@
 """run things only once."""
 
+from __future__ import with_statement
+
 import functools
+import threading
 
-# TODO: make it threadsafe; memoization based on arguments?
+# TODO: memoization based on arguments?
 
 def fun(wrapped):
+    """Run `wrapped' only once, returning the result of that first
+    call ever after. Concurrent first calls wait for the one that runs
+    `wrapped'; if it raises, the next call tries again."""
+    lock = threading.RLock()
+
     @functools.wraps(wrapped)
     def wrapper(*args, **kwargs):
         if not hasattr(wrapper, '_once_res'):
-            wrapper._once_res = wrapped(*args, **kwargs)            
+            with lock:
+                if not hasattr(wrapper, '_once_res'):
+                    wrapper._once_res = wrapped(*args, **kwargs)
 
         return wrapper._once_res
 
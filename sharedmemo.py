@@ -0,0 +1,179 @@
+"""A memo of pickled values in an anonymous shared memory segment, so
+that processes forked after creating it share one copy of each value,
+and one computation of it. This backs
+util.functional.memoize_shared.
+
+The segment is divided into stripes, each with its own process-shared
+lock, a hash table (open addressing, indexed by MD5 digests of the
+canonically encoded keys) and an arena the values are appended to.
+Keys hash to a stripe, so processes only contend for the same stripe.
+When a stripe's arena or table is full, the stripe is wiped, which
+bounds memory by the segment size at the cost of recomputing that
+stripe's entries."""
+
+from __future__ import with_statement
+
+import os
+import mmap
+import time
+import errno
+import struct
+import hashlib
+import cPickle
+import multiprocessing
+
+from util.digest import canonical_str
+
+__all__ = ['SharedMemo']
+
+_EMPTY, _PENDING, _READY, _DELETED = range(4)
+
+# state, digest, arena offset, length, pid of the computing process
+_slot = struct.Struct('<B16sQIi')
+# arena bytes used
+_stripe_header = struct.Struct('<Q')
+
+def _digest(key):
+    return hashlib.md5(canonical_str(key)).digest()
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno != errno.ESRCH
+    return True
+
+class SharedMemo(object):
+    """A memo of `size' bytes in `stripes' stripes, to be created
+    before forking. Keys must be canonically encodable (see
+    util.digest.canonical_str), values picklable."""
+
+    def __init__(self, size=64 << 20, stripes=64, max_wait=60):
+        self.stripes = stripes
+        self.max_wait = max_wait
+        self.stripe_size = size // stripes
+        self.slots = max(16, self.stripe_size // 1024)
+        self.arena_offset = _stripe_header.size + self.slots * _slot.size
+        self.arena_size = self.stripe_size - self.arena_offset
+        assert self.arena_size > 0, 'shared memo too small'
+
+        self.map = mmap.mmap(-1, self.stripe_size * stripes)
+        self.locks = [multiprocessing.Lock() for _ in xrange(stripes)]
+
+    def get(self, key, fun, *args, **kwargs):
+        """Return the value for `key', computing it as ``fun(*args,
+        **kwargs)'' if needed. While a process computes it, others
+        asking for it wait for at most `max_wait' seconds before
+        computing it themselves."""
+        digest = _digest(key)
+        stripe = ord(digest[0]) % self.stripes
+        lock = self.locks[stripe]
+
+        deadline = time.time() + self.max_wait
+        delay = 0.001
+        while True:
+            with lock:
+                i, state, offset, length, pid = self._find(stripe, digest)
+                if state == _READY:
+                    base = self._arena(stripe) + offset
+                    data = self.map[base:base + length]
+                    break
+                elif (state == _PENDING and _alive(pid) and
+                      time.time() < deadline):
+                    pass
+                else:
+                    if i is not None:
+                        self._set_slot(stripe, i, _PENDING, digest, 0, 0)
+                    data = None
+                    break
+
+            time.sleep(delay)
+            delay = min(2 * delay, 0.05)
+
+        if data is not None:
+            return cPickle.loads(data)
+
+        try:
+            value = fun(*args, **kwargs)
+        except:
+            with lock:
+                self._release(stripe, digest)
+            raise
+
+        self._store(stripe, digest,
+                    cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL))
+        return value
+
+    def __contains__(self, key):
+        digest = _digest(key)
+        stripe = ord(digest[0]) % self.stripes
+        with self.locks[stripe]:
+            return self._find(stripe, digest)[1] == _READY
+
+    # These expect the stripe's lock to be held, unless noted.
+
+    def _store(self, stripe, digest, data):
+        """Store `data' for `digest', taking the stripe's lock."""
+        with self.locks[stripe]:
+            if len(data) > self.arena_size:
+                self._release(stripe, digest)
+                return
+
+            used = self._used(stripe)
+            i = self._find(stripe, digest)[0]
+            if i is None or used + len(data) > self.arena_size:
+                self._wipe(stripe)
+                used = 0
+                i = self._find(stripe, digest)[0]
+
+            base = self._arena(stripe) + used
+            self.map[base:base + len(data)] = data
+            self._set_used(stripe, used + len(data))
+            self._set_slot(stripe, i, _READY, digest, used, len(data))
+
+    def _release(self, stripe, digest):
+        """Give up our claim on `digest'."""
+        i, state, _, _, pid = self._find(stripe, digest)
+        if state == _PENDING and pid == os.getpid():
+            self._set_slot(stripe, i, _DELETED, digest, 0, 0)
+
+    def _find(self, stripe, digest):
+        """Return (slot, state, offset, length, pid) for `digest', or
+        the slot it can be stored in with an _EMPTY state (None if the
+        table is full)."""
+        base = stripe * self.stripe_size + _stripe_header.size
+        start = struct.unpack_from('<I', digest, 4)[0] % self.slots
+        free = None
+        for n in xrange(self.slots):
+            i = (start + n) % self.slots
+            state, slot_digest, offset, length, pid = _slot.unpack_from(
+                self.map, base + i * _slot.size)
+            if state == _EMPTY:
+                return (i if free is None else free), _EMPTY, 0, 0, 0
+            elif state == _DELETED:
+                if free is None:
+                    free = i
+            elif slot_digest == digest:
+                return i, state, offset, length, pid
+
+        return free, _EMPTY, 0, 0, 0
+
+    def _set_slot(self, stripe, i, state, digest, offset, length):
+        _slot.pack_into(self.map,
+                        stripe * self.stripe_size + _stripe_header.size +
+                        i * _slot.size,
+                        state, digest, offset, length, os.getpid())
+
+    def _arena(self, stripe):
+        return stripe * self.stripe_size + self.arena_offset
+
+    def _used(self, stripe):
+        return _stripe_header.unpack_from(
+            self.map, stripe * self.stripe_size)[0]
+
+    def _set_used(self, stripe, used):
+        _stripe_header.pack_into(self.map, stripe * self.stripe_size, used)
+
+    def _wipe(self, stripe):
+        base = stripe * self.stripe_size
+        self.map[base:base + self.arena_offset] = '\0' * self.arena_offset
@@ -6,14 +6,20 @@ __all__ = ['bigsorted']
 
 import os
 import sys
-from util.iter import merge
+import heapq
+import zlib
 import struct
 import tempfile
+from collections import deque
+from contextlib import nested
 
 MAX_MEMORY = 100 * 1024 * 1024
+MAX_FANIN = 64
 
 def bigsorted(iterable, key=None, cmp=None, serialize=str, deserialize=str,
-              max_memory=MAX_MEMORY, tmpdir=None):
+              max_memory=MAX_MEMORY, tmpdir=None, fanin=MAX_FANIN,
+              serialize_key=None, deserialize_key=None, workers=None,
+              compress=0, replacement=False):
     '''
     Sort iterable that is too large to fit in memory.
       key: Key lambda
@@ -23,13 +29,35 @@ def bigsorted(iterable, key=None, cmp=None, serialize=str, deserialize=str,
       max_memory: Maximum number of serialized bytes to store in memory.
          The default is 100 MB. Note actual memory usage will be higher
          due to Python overhead.
+      fanin: Maximum number of sorted files to merge at once (and so
+         to have open). If there are more, they are merged in several
+         passes.
+      serialize_key: Key serializer lambda. If given, keys are stored
+         with the elements on disk, and merges compare them instead of
+         deserializing elements and recomputing their keys.
+      deserialize_key: Key deserializer lambda. If not given, stored
+         keys are compared as strings, so serialize_key must preserve
+         the order of keys (as given by cmp).
+      workers: Number of processes to build the sorted files in. The
+         input is split into chunks of about max_memory (estimated)
+         serialized bytes, which the workers key, serialize, sort and
+         write; memory usage goes up accordingly. Elements must be
+         picklable.
+      compress: zlib compression level of the sorted files, 0 (the
+         default) for none.
+      replacement: Build the sorted files by replacement selection,
+         which makes them about twice max_memory on random input, and
+         makes a single one of (mostly) presorted input. Not with
+         workers.
     '''
     # Wrap around _bigsort to track tempfiles.  This ensure we don't
     # leave giant tempfiles on disk if something goes wrong.
     tmpfiles = []
     try:
         for element in _bigsorted(tmpfiles, iterable, key, cmp,
-                                  serialize, deserialize, max_memory, tmpdir):
+                                  serialize, deserialize, max_memory, tmpdir,
+                                  fanin, serialize_key, deserialize_key,
+                                  workers, compress, replacement):
             yield element
     finally:
         for tmpfile in tmpfiles:
@@ -40,25 +68,61 @@ def bigsorted(iterable, key=None, cmp=None, serialize=str, deserialize=str,
 
 def _bigsorted(tmpfiles, iterable, key=None, cmp=None,
                serialize=str, deserialize=str,
-               max_memory=MAX_MEMORY, tmpdir=None):
+               max_memory=MAX_MEMORY, tmpdir=None, fanin=MAX_FANIN,
+               serialize_key=None, deserialize_key=None, workers=None,
+               compress=0, replacement=False):
+    assert fanin >= 2
+    assert not (workers and replacement)
     if key is None:
         key = lambda x: x
     if cmp is None:
         cmp = __builtins__['cmp']
 
-    # Iterate over all elements.  Store in key_to_bytes.  If
-    # key_to_bytes is too big, sort and write to disk.
-    num_bytes    = 0
-    key_to_bytes = {} # key -> list of bytes with key
-    for element in iterable:
-        k = key(element)
-        bytes = serialize(element)
-        key_to_bytes.setdefault(k, []).append(bytes)
-        num_bytes += len(bytes)
-        if num_bytes > max_memory:
-            _write_key_to_bytes(tmpfiles, key_to_bytes, cmp, tmpdir)
-            key_to_bytes.clear()
-            num_bytes = 0
+    # How sorted files are read, written and merged: either as
+    # elements, or as (stored key, serialized element) pairs.
+    if serialize_key is None:
+        merge_cmp = cmp
+        read_file = lambda f: _each_file_key_element(f, key, deserialize)
+        write = lambda file, elem: _write_element(file, elem, serialize)
+        each_dict = lambda: _each_dict_key_element(key_to_bytes, cmp,
+                                                   deserialize)
+        output = lambda elem: elem
+    else:
+        if deserialize_key is None:
+            merge_cmp, load_key = __builtins__['cmp'], lambda kb: kb
+            merge_key = serialize_key
+        else:
+            merge_cmp, load_key = cmp, deserialize_key
+            merge_key = lambda k: k
+        read_file = lambda f: _each_file_key_bytes(f, load_key)
+        write = _write_key_bytes
+        each_dict = lambda: _each_dict_key_bytes(key_to_bytes, cmp,
+                                                 merge_key)
+        output = lambda elem: deserialize(elem[1])
+
+    if workers:
+        key_to_bytes = _parallel_runs(tmpfiles, iterable, key, cmp,
+                                      serialize, max_memory, tmpdir,
+                                      serialize_key, workers, compress)
+    elif replacement:
+        key_to_bytes = _replacement_runs(tmpfiles, iterable, key, cmp,
+                                         serialize, max_memory, tmpdir,
+                                         serialize_key, compress)
+    else:
+        # Iterate over all elements.  Store in key_to_bytes.  If
+        # key_to_bytes is too big, sort and write to disk.
+        num_bytes    = 0
+        key_to_bytes = {} # key -> list of bytes with key
+        for element in iterable:
+            k = key(element)
+            bytes = serialize(element)
+            key_to_bytes.setdefault(k, []).append(bytes)
+            num_bytes += len(bytes)
+            if num_bytes > max_memory:
+                _write_key_to_bytes(tmpfiles, key_to_bytes, cmp, tmpdir,
+                                    serialize_key, compress)
+                key_to_bytes.clear()
+                num_bytes = 0
 
     if not tmpfiles:
         # Nothing was written to disk, yield what's in memory.
@@ -66,53 +130,248 @@ def _bigsorted(tmpfiles, iterable, key=None, cmp=None,
             yield elem
         raise StopIteration
 
-    # Merge sorted files until there's only one left
-    while len(tmpfiles) > 1:
-        filename1 = tmpfiles[0]
-        with open(filename1) as file1:
-            filename2 = tmpfiles[1]
-            with open(filename2) as file2:
+    # Merge runs of fanin sorted files into one until we can merge the
+    # rest with key_to_bytes in one pass, so each element is rewritten
+    # about log(number of files, fanin) times.
+    runs = list(tmpfiles)
+    while len(runs) + 1 > fanin:
+        merged = []
+        for i in xrange(0, len(runs), fanin):
+            filenames = runs[i:i + fanin]
+            if len(filenames) == 1:
+                merged.extend(filenames)
+                continue
+
+            fd, filename = tempfile.mkstemp('.bigsort', dir=tmpdir)
+            tmpfiles.append(filename)
+            merged.append(filename)
+            with nested(*map(_RunReader, filenames)) as files:
+                with _RunWriter(os.fdopen(fd, 'wb'), compress) as file:
+                    iters = map(read_file, files)
+                    for _, elem in _merge(iters, merge_cmp):
+                        write(file, elem)
+            for name in filenames:
+                os.remove(name)
+                tmpfiles.remove(name)
+        runs = merged
+
+    # Merge the last sorted files with key_to_bytes
+    with nested(*map(_RunReader, runs)) as files:
+        iters = map(read_file, files)
+        iters.append(each_dict())
+        for _, elem in _merge(iters, merge_cmp):
+            yield output(elem)
+    for name in runs:
+        os.remove(name)
+        tmpfiles.remove(name)
+
+class _CmpKey(object):
+    """Orders keys by a cmp function, for heapq."""
+    __slots__ = ['key', 'cmp']
+
+    def __init__(self, key, cmp):
+        self.key = key
+        self.cmp = cmp
+
+    def __lt__(self, other):
+        return self.cmp(self.key, other.key) < 0
+
+    def __le__(self, other):
+        return self.cmp(self.key, other.key) <= 0
+
+    # Tuples compare their items with == before ordering them, so
+    # these decide whether ties fall through to the next item.
+    def __eq__(self, other):
+        return self.cmp(self.key, other.key) == 0
+
+    def __ne__(self, other):
+        return self.cmp(self.key, other.key) != 0
+
+    def __gt__(self, other):
+        return self.cmp(self.key, other.key) > 0
+
+    def __ge__(self, other):
+        return self.cmp(self.key, other.key) >= 0
+
+def _merge(iters, cmp):
+    """Merge sorted iterators of (key, element) in one pass, with a
+    heap. Elements with equal keys come in the order of `iters'."""
+    if cmp is __builtins__['cmp']:
+        wrap = lambda k: k
+    else:
+        wrap = lambda k: _CmpKey(k, cmp)
+
+    heap = []
+    for i, it in enumerate(iters):
+        for k, elem in it:
+            heap.append((wrap(k), i, k, elem, it))
+            break
+    heapq.heapify(heap)
+
+    while heap:
+        _, i, k, elem, it = heap[0]
+        yield k, elem
+        for k, elem in it:
+            heapq.heapreplace(heap, (wrap(k), i, k, elem, it))
+            break
+        else:
+            heapq.heappop(heap)
+
+def _replacement_runs(tmpfiles, iterable, key, cmp, serialize, max_memory,
+                      tmpdir, serialize_key, compress):
+    """Write sorted files of `iterable' by replacement selection: keep
+    a heap of up to `max_memory' bytes of elements, and write out the
+    smallest that can still go in the current file, until there's
+    none. Returns key_to_bytes of the elements left for the next
+    file."""
+    if cmp is __builtins__['cmp']:
+        wrap = lambda k: k
+    else:
+        wrap = lambda k: _CmpKey(k, cmp)
+
+    # Heap entries are (run, key for the heap, sequence number, key,
+    # bytes), where run is the number of the file the element goes in.
+    heap      = []
+    num_bytes = 0
+    run       = 0
+    last      = None
+    file      = None
+    try:
+        for seq, element in enumerate(iterable):
+            k = key(element)
+            bytes = serialize(element)
+            if file is not None and cmp(k, last) < 0:
+                # Too late for the current file.
+                heapq.heappush(heap, (run + 1, wrap(k), seq, k, bytes))
+            else:
+                heapq.heappush(heap, (run, wrap(k), seq, k, bytes))
+            num_bytes += len(bytes)
+
+            while num_bytes > max_memory:
+                r, _, _, last, bytes = heapq.heappop(heap)
+                if file is None or r != run:
+                    if file is not None:
+                        file.close()
+                    fd, filename = tempfile.mkstemp('.bigsort', dir=tmpdir)
+                    tmpfiles.append(filename)
+                    file = _RunWriter(os.fdopen(fd, 'wb'), compress)
+                    run = r
+                _write_key_record(file, last, bytes, serialize_key)
+                num_bytes -= len(bytes)
+
+        if file is not None:
+            while heap and heap[0][0] == run:
+                _, _, _, k, bytes = heapq.heappop(heap)
+                _write_key_record(file, k, bytes, serialize_key)
+    finally:
+        if file is not None:
+            file.close()
+
+    key_to_bytes = {}
+    for _, _, _, k, bytes in sorted(heap):
+        key_to_bytes.setdefault(k, []).append(bytes)
+    return key_to_bytes
+
+def _parallel_runs(tmpfiles, iterable, key, cmp, serialize, max_memory,
+                   tmpdir, serialize_key, workers, compress):
+    """Have `workers' processes write sorted files of the chunks of
+    `iterable', but the last, which is returned as key_to_bytes."""
+    # Not imported at the top, since it's rather large.
+    import multiprocessing
+
+    pool = multiprocessing.Pool(workers, _run_init,
+                                (key, cmp, serialize, serialize_key,
+                                 compress))
+    try:
+        # Keep at most two chunks per worker in flight.
+        pending = deque()
+        last = []
+        for chunk in _chunks(iterable, serialize, max_memory):
+            if last:
                 fd, filename = tempfile.mkstemp('.bigsort', dir=tmpdir)
+                os.close(fd)
                 tmpfiles.append(filename)
-                with os.fdopen(fd, 'w') as file:
-                    iter1 = _each_file_key_element(file1, key, deserialize)
-                    iter2 = _each_file_key_element(file2, key, deserialize)
-                    for _, elem in merge(iter1, iter2,
-                                         lambda x,y: cmp(x[0], y[0])):
-                        _write_element(file, elem, serialize)
-            os.remove(filename2)
-            assert tmpfiles[1] == filename2
-            del tmpfiles[1]
-        os.remove(filename1)
-        tmpfiles.pop(0)
-
-    # Merge last sorted file with key_to_bytes
-    assert len(tmpfiles) == 1
-    filename = tmpfiles[0]
-    with open(filename) as file:
-        iter1 = _each_file_key_element(file, key, deserialize)
-        iter2 = _each_dict_key_element(key_to_bytes, cmp, deserialize)
-        for _, element in merge(iter1, iter2, lambda x,y: cmp(x[0], y[0])):
-            yield element
-    os.remove(filename)
-    tmpfiles.pop(0)
+                pending.append(pool.apply_async(_run_chunk, (filename, last)))
+                if len(pending) >= 2 * workers:
+                    pending.popleft().get()
+            last = chunk
+
+        while pending:
+            pending.popleft().get()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    key_to_bytes = {}
+    for element in last:
+        key_to_bytes.setdefault(key(element), []).append(serialize(element))
+    return key_to_bytes
+
+def _chunks(iterable, serialize, max_memory, sample=100):
+    """Split `iterable' into lists of about `max_memory' serialized
+    bytes, estimated by serializing a sample of the elements."""
+    chunk, num_bytes = [], 0
+    sampled, sampled_bytes = 0, 0
+    for i, element in enumerate(iterable):
+        if sampled < sample or i % sample == 0:
+            sampled += 1
+            sampled_bytes += len(serialize(element))
+        chunk.append(element)
+        num_bytes += float(sampled_bytes) / sampled
+        if num_bytes > max_memory:
+            yield chunk
+            chunk, num_bytes = [], 0
 
-def _write_key_to_bytes(tmpfiles, key_to_bytes, cmp, tmpdir):
+    if chunk:
+        yield chunk
+
+_run_job = None
+
+def _run_init(*job):
+    global _run_job
+    _run_job = job
+
+def _run_chunk(filename, elements):
+    key, cmp, serialize, serialize_key, compress = _run_job
+    key_to_bytes = {}
+    for element in elements:
+        key_to_bytes.setdefault(key(element), []).append(serialize(element))
+    with _RunWriter(open(filename, 'wb'), compress) as file:
+        _write_sorted(file, key_to_bytes, cmp, serialize_key)
+
+def _write_key_to_bytes(tmpfiles, key_to_bytes, cmp, tmpdir,
+                        serialize_key=None, compress=0):
     fd, filename = tempfile.mkstemp('.bigsort', dir=tmpdir)
     tmpfiles.append(filename)
-    with os.fdopen(fd, 'w') as file:
-        for key in sorted(key_to_bytes.keys(), cmp=cmp):
-            for bytes in key_to_bytes[key]:
-                _write_bytes(file, bytes)
+    with _RunWriter(os.fdopen(fd, 'wb'), compress) as file:
+        _write_sorted(file, key_to_bytes, cmp, serialize_key)
+
+def _write_sorted(file, key_to_bytes, cmp, serialize_key=None):
+    for key in sorted(key_to_bytes.keys(), cmp=cmp):
+        if serialize_key is not None:
+            key_bytes = serialize_key(key)
+        for bytes in key_to_bytes[key]:
+            if serialize_key is not None:
+                _write_bytes(file, key_bytes)
+            _write_bytes(file, bytes)
+
+def _write_key_record(file, key, bytes, serialize_key=None):
+    if serialize_key is not None:
+        _write_bytes(file, serialize_key(key))
+    _write_bytes(file, bytes)
+
+def _write_key_bytes(file, key_bytes_bytes):
+    key_bytes, bytes = key_bytes_bytes
+    _write_bytes(file, key_bytes)
+    _write_bytes(file, bytes)
 
 def _write_element(file, element, serialize):
     bytes = serialize(element)
     _write_bytes(file, bytes)
 
 def _write_bytes(file, bytes):
-    length_bytes = struct.pack('I', len(bytes))
-    file.write(length_bytes)
-    file.write(bytes)
+    file.write_record(bytes)
 
 def _each_dict_key_element(key_to_bytes, cmp, deserialize):
     for key in sorted(key_to_bytes.keys(), cmp=cmp):
@@ -120,6 +379,20 @@ def _each_dict_key_element(key_to_bytes, cmp, deserialize):
             element = deserialize(bytes)
             yield key, element
 
+def _each_dict_key_bytes(key_to_bytes, cmp, merge_key):
+    for key in sorted(key_to_bytes.keys(), cmp=cmp):
+        k = merge_key(key)
+        for bytes in key_to_bytes[key]:
+            yield k, (None, bytes)
+
+def _each_file_key_bytes(file, load_key):
+    while True:
+        try:
+            key_bytes = _read_element(file, str)
+        except EOFError:
+            break
+        yield load_key(key_bytes), (key_bytes, _read_element(file, str))
+
 def _each_file_key_element(file, key, deserialize):
     for element in _each_file_element(file, deserialize):
         k = key(element)
@@ -134,12 +407,95 @@ def _each_file_element(file, deserialize):
             break
 
 def _read_element(file, deserialize):
-    bytes = file.read(4)
-    if not bytes:
-        raise EOFError
-    (length,) = struct.unpack('I', bytes)
-    bytes = file.read(length)
-    if not bytes or len(bytes) != length:
-        raise EOFError
+    bytes = file.read_record()
     element = deserialize(bytes)
     return element
+
+# Sorted files are sequences of blocks of about BLOCK_SIZE bytes of
+# records. Blocks have a header (whether the block is compressed, the
+# length of its data), and their records a length.
+BLOCK_SIZE = 256 * 1024
+_block_header = struct.Struct('<BI')
+_record_length = struct.Struct('<I')
+
+class _RunWriter(object):
+    def __init__(self, file, compress=0, block_size=None):
+        self.file = file
+        self.compress = compress
+        self.block_size = block_size or BLOCK_SIZE
+        self.block = []
+        self.size = 0
+
+    def write_record(self, bytes):
+        self.block.append(_record_length.pack(len(bytes)))
+        self.block.append(bytes)
+        self.size += _record_length.size + len(bytes)
+        if self.size >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        if not self.block:
+            return
+
+        data = ''.join(self.block)
+        compressed = False
+        if self.compress:
+            zdata = zlib.compress(data, self.compress)
+            if len(zdata) < len(data):
+                data, compressed = zdata, True
+
+        self.file.write(_block_header.pack(compressed, len(data)))
+        self.file.write(data)
+        self.block = []
+        self.size = 0
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        if type is None:
+            self.close()
+        else:
+            self.file.close()
+
+class _RunReader(object):
+    def __init__(self, filename):
+        self.file = open(filename, 'rb')
+        self.block = ''
+        self.pos = 0
+
+    def read_record(self):
+        if self.pos >= len(self.block):
+            self._read_block()
+
+        (length,) = _record_length.unpack_from(self.block, self.pos)
+        start = self.pos + _record_length.size
+        self.pos = start + length
+        if self.pos > len(self.block):
+            raise EOFError
+        return self.block[start:self.pos]
+
+    def _read_block(self):
+        header = self.file.read(_block_header.size)
+        if len(header) != _block_header.size:
+            raise EOFError
+        compressed, length = _block_header.unpack(header)
+        data = self.file.read(length)
+        if len(data) != length:
+            raise EOFError
+
+        self.block = zlib.decompress(data) if compressed else data
+        self.pos = 0
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
@@ -22,9 +22,21 @@ def rpeel(s, by):
     else:
         return ret[0], ret[1]
 
-def compress_hex(hex, alphabet=('abcdefghijklmnopqrstuvwxyz'
-                                'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789')):
-    return ''.join([alphabet[ord(b) % len(alphabet)] for b in unhexlify(hex)])
+_alphanumeric = ('abcdefghijklmnopqrstuvwxyz'
+                 'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789')
+_compress_tables = {}
+
+def compress_bytes(bytes, alphabet=_alphanumeric):
+    """Map each byte of `bytes' to a character of `alphabet' (by its
+    value modulo the alphabet's length)."""
+    table = _compress_tables.get(alphabet)
+    if table is None:
+        table = _compress_tables[alphabet] = ''.join(
+            [alphabet[i % len(alphabet)] for i in xrange(256)])
+    return bytes.translate(table)
+
+def compress_hex(hex, alphabet=_alphanumeric):
+    return compress_bytes(unhexlify(hex), alphabet)
 
 def compress_hex_to_alphanumeric(hex):
     """Compress 2n hex chars down to n alphanumeric chars.  This is lossy.
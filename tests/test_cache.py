@@ -1,3 +1,5 @@
+import datetime
+import threading
 import time
 import unittest
 from itertools import count
@@ -24,6 +26,25 @@ def decorated(x):
     return x
 decorated.runcount = 0
 
+def batched_squares(argslist):
+    batched_squares.runcount += 1
+    return [x * x for (x,) in argslist]
+batched_squares.runcount = 0
+
+@cache.cache('squares', 60, batch=batched_squares)
+def squares(x):
+    squares.runcount += 1
+    return x * x
+squares.runcount = 0
+
+class Ticket(object):
+    def __init__(self, expires_at):
+        self.expires_at = expires_at
+
+def clear_backend():
+    dcache.cache._cache.clear()
+    dcache.cache._expire_info.clear()
+
 class TestCache(unittest.TestCase):
     def setUp(self):
         identity.runcount = 0
@@ -31,6 +52,8 @@ class TestCache(unittest.TestCase):
         # :-( Testing with django caching is a bit of a PITA.
         dcache.cache = dcache.get_cache('locmem:///')
         dcache.cache._cache.clear()
+        cache._namespaces.clear()
+        cache._generations.clear()
 
     def tearDown(self):
         dcache.cache = dcache.get_cache(settings.CACHE_BACKEND)
@@ -94,6 +117,364 @@ class TestCache(unittest.TestCase):
         cache.cache_('ns', 2, identity, 'hi')
         self.assertEquals(2, identity.runcount)
 
+    def test_local(self):
+        """Local hits don't go to the backend."""
+        cache.configure('local', local_size=10)
+        cache.cache_('local', 60, identity, 'hi')
+        clear_backend()
+        cache.cache_('local', 60, identity, 'hi')
+        self.assertEquals(1, identity.runcount)
+
+    def test_local_bounds(self):
+        cache.configure('local', local_size=2, local_bytes=None)
+        for x in range(3):
+            cache.cache_('local', 60, identity, x)
+        clear_backend()
+        cache.cache_('local', 60, identity, 0)
+        self.assertEquals(4, identity.runcount)
+        cache.cache_('local', 60, identity, 2)
+        self.assertEquals(4, identity.runcount)
+
+        cache.configure('local', local_size=None, local_bytes=1)
+        cache.cache_('local', 60, identity, 'big')
+        clear_backend()
+        cache.cache_('local', 60, identity, 'big')
+        self.assertEquals(6, identity.runcount)
+
+    def test_local_timeout(self):
+        cache.configure('local', local_size=10, local_timeout=1)
+        cache.cache_('local', 60, identity, 'hi')
+        clear_backend()
+        time.sleep(2)
+        cache.cache_('local', 60, identity, 'hi')
+        self.assertEquals(2, identity.runcount)
+
+    def test_local_backend_expiry(self):
+        """A copy fetched late in the backend entry's life expires with
+        it."""
+        cache.configure('local', local_size=10)
+        cache.cache_('local', 2, identity, 'hi')
+        # Another process, with nothing cached locally yet.
+        cache._namespaces['local'].local.clear()
+        time.sleep(1)
+        cache.cache_('local', 2, identity, 'hi')
+        self.assertEquals(1, identity.runcount)
+        time.sleep(1.5)
+        cache.cache_('local', 2, identity, 'hi')
+        self.assertEquals(2, identity.runcount)
+
+    def test_local_expires_at(self):
+        """Values' own expires_at attributes are theirs."""
+        for expires_at in [datetime.datetime(2000, 1, 1), 0]:
+            cache._namespaces.clear()
+            fun = lambda x: identity() and Ticket(x)
+            cache.cache_('local', 60, fun, expires_at)
+            cache.configure('local', local_size=10)
+            ticket = cache.cache_('local', 60, fun, expires_at)
+            self.assertEquals(expires_at, ticket.expires_at)
+            clear_backend()
+            self.assert_(cache.cache_('local', 60, fun, expires_at) is ticket)
+        self.assertEquals(2, identity.runcount)
+
+    def test_local_invalidate(self):
+        cache.configure('keyed', local_size=10)
+        keyed(1, 2)
+        cache.invalidate_cache_key('keyed', '1')
+        keyed(1, 2)
+        self.assertEquals(2, keyed.runcount)
+
+    def test_single_flight(self):
+        cache.configure('flight', single_flight=True)
+        def slow():
+            time.sleep(0.2)
+            return identity()
+        threads = [threading.Thread(target=cache.cache_,
+                                    args=('flight', 60, slow))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(1, identity.runcount)
+
+    def test_single_flight_lease(self):
+        """Somebody else holds the lease: wait for them, or fall back
+        to the stale copy."""
+        cache.configure('flight', single_flight=True, lease_wait=0.2,
+                        stale_timeout=60)
+        key = cache._mk_key('flight', ((), frozenset()))
+        cache.cache_('flight', 60, identity)
+        dcache.cache.delete(key)
+        dcache.cache.add(key + '.lease', 1, 60)
+        self.assertEquals(((), {}), cache.cache_('flight', 60, identity))
+        self.assertEquals(1, identity.runcount)
+
+        dcache.cache.delete(key + '.stale')
+        self.assertEquals(((), {}), cache.cache_('flight', 60, identity))
+        self.assertEquals(2, identity.runcount)
+
+    def test_single_flight_lease_threads(self):
+        """Threads waiting on a lease held elsewhere share one
+        computation."""
+        cache.configure('flight', single_flight=True, lease_wait=0.5)
+        key = cache._mk_key('flight', ((), frozenset()))
+        dcache.cache.add(key + '.lease', 1, 60)
+        threads = [threading.Thread(target=cache.cache_,
+                                    args=('flight', 60, identity))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(1, identity.runcount)
+
+    def test_single_flight_error(self):
+        """Threads waiting on a failed computation don't all retry it."""
+        cache.configure('flight', single_flight=True)
+        def failing():
+            time.sleep(0.2)
+            identity()
+            raise ValueError
+        errors = []
+        def call():
+            try:
+                cache.cache_('flight', 60, failing)
+            except ValueError:
+                errors.append(1)
+        threads = [threading.Thread(target=call) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(5, len(errors))
+        self.assertEquals(1, identity.runcount)
+
+    def test_single_flight_lease_released(self):
+        """The lease we get may have been released by somebody who just
+        stored the value."""
+        cache.configure('flight', single_flight=True)
+        key = cache._mk_key('flight', ((), frozenset()))
+        add = dcache.cache.add
+        def add_after_store(*args):
+            cache._store(cache._config('flight'), key, 'elsewhere', 60)
+            return add(*args)
+        dcache.cache.add = add_after_store
+        try:
+            self.assertEquals('elsewhere',
+                              cache.cache_('flight', 60, identity))
+        finally:
+            del dcache.cache.add
+        self.assertEquals(0, identity.runcount)
+
+    def test_soft_timeout(self):
+        cache.configure('soft', soft_timeout=1)
+        runs = count()
+        fun = lambda: runs.next()
+        self.assertEquals(0, cache.cache_('soft', 60, fun))
+        self.assertEquals(0, cache.cache_('soft', 60, fun))
+        time.sleep(1.1)
+
+        before = cache.refresh_counters()
+        # Served stale while refreshing in the background.
+        self.assertEquals(0, cache.cache_('soft', 60, fun))
+        for _ in range(50):
+            if cache.refresh_counters()['refreshed'] > before['refreshed']:
+                break
+            time.sleep(0.1)
+        after = cache.refresh_counters()
+        self.assertEquals(before['scheduled'] + 1, after['scheduled'])
+        self.assertEquals(before['refreshed'] + 1, after['refreshed'])
+        self.assertEquals(1, cache.cache_('soft', 60, fun))
+
+    def test_soft_timeout_refreshed_elsewhere(self):
+        """A local copy due for a refresh picks up the value another
+        process refreshed, rather than computing it again."""
+        cache.configure('soft', soft_timeout=1, local_size=10)
+        runs = count()
+        fun = lambda: runs.next()
+        self.assertEquals(0, cache.cache_('soft', 60, fun))
+        time.sleep(1.1)
+
+        key = cache._mk_key('soft', ((), frozenset()))
+        cache._store(cache._config('soft'), key, 'fresh', 60)
+        before = cache.refresh_counters()
+        self.assertEquals(0, cache.cache_('soft', 60, fun))
+        for _ in range(50):
+            if cache.refresh_counters()['leased'] > before['leased']:
+                break
+            time.sleep(0.1)
+        after = cache.refresh_counters()
+        self.assertEquals(before['refreshed'], after['refreshed'])
+        self.assertEquals('fresh', cache.cache_('soft', 60, fun))
+        self.assertEquals(1, runs.next())
+
+    def test_many(self):
+        self.assertEquals((1, 2), keyed(1, 2))
+        self.assertEquals([(1, 2), (2, 3), (1, 2)],
+                          keyed.many([(1, 2), (2, 3), (1, 4)]))
+        self.assertEquals(2, keyed.runcount)
+        self.assertEquals([(2, 3)], keyed.many([(2, 5)]))
+        self.assertEquals(2, keyed.runcount)
+
+    def test_many_defaults(self):
+        """``many'' shares keys with plain calls relying on defaults."""
+        @cache.cache('defaults', 60)
+        def f(x, y=2):
+            identity()
+            return x * y
+        self.assertEquals(2, f(1))
+        self.assertEquals([2, 4, 3], f.many([1, 2, (1, 3)]))
+        self.assertEquals(3, identity.runcount)
+        self.assertEquals(4, f(2))
+        self.assertEquals(3, identity.runcount)
+
+    def test_many_batch(self):
+        squares.runcount = batched_squares.runcount = 0
+        self.assertEquals(4, squares(2))
+        self.assertEquals([1, 4, 9, 1], squares.many([1, 2, 3, 1]))
+        self.assertEquals(1, squares.runcount)
+        self.assertEquals(1, batched_squares.runcount)
+        self.assertEquals(9, squares(3))
+        self.assertEquals(1, squares.runcount)
+
+    def test_many_batch_mismatch(self):
+        def short_batch(argslist):
+            return [0]
+        self.assertRaises(ValueError, cache.cache_many_, 'short', 60,
+                          identity, [1, 2, 3], batch=short_batch)
+        self.assertEquals([((1,), {})],
+                          cache.cache_many_('short', 60, identity, [1]))
+
+    def test_none(self):
+        def nothing():
+            identity()
+        for _ in range(5):
+            self.assertEquals(None, cache.cache_('none', 60, nothing))
+        self.assertEquals(1, identity.runcount)
+        self.assertEquals([None], cache.cache_many_('none', 60, nothing, [()]))
+        self.assertEquals(1, identity.runcount)
+
+    def test_negative_timeout(self):
+        cache.configure('none', negative_timeout=1)
+        def empty(x):
+            identity()
+            return x
+        self.assertEquals(None, cache.cache_('none', 60, empty, None))
+        self.assertEquals([], cache.cache_('none', 60, empty, []))
+        self.assertEquals(1, cache.cache_('none', 60, empty, 1))
+        self.assertEquals(3, identity.runcount)
+        time.sleep(2)
+        self.assertEquals(None, cache.cache_('none', 60, empty, None))
+        self.assertEquals([], cache.cache_('none', 60, empty, []))
+        self.assertEquals(1, cache.cache_('none', 60, empty, 1))
+        self.assertEquals(5, identity.runcount)
+
+    def test_invalidate_namespace(self):
+        cache.configure('keyed', local_size=10)
+        for x in range(10):
+            keyed(x, x)
+        keyed(0, 0)
+        self.assertEquals(10, keyed.runcount)
+        cache.invalidate_namespace('keyed')
+        for x in range(10):
+            keyed(x, x)
+        self.assertEquals(20, keyed.runcount)
+
+        # Other namespaces are left alone.
+        decorated.runcount = 0
+        decorated(1)
+        cache.invalidate_namespace('keyed')
+        decorated(1)
+        self.assertEquals(1, decorated.runcount)
+
+    def test_invalidate_namespace_elsewhere(self):
+        """Another process bumped the generation."""
+        keyed(1, 1)
+        dcache.cache.incr(cache._generation_key('keyed'))
+        keyed(1, 1)
+        self.assertEquals(1, keyed.runcount)
+        cache._generations.clear()
+        keyed(1, 1)
+        self.assertEquals(2, keyed.runcount)
+
+    def test_compress(self):
+        cache.configure('codec', compress_threshold=100)
+        big = 'x' * 1000
+        self.assertEquals(big, cache.cache_('codec', 60, lambda: big))
+        self.assertEquals(big, cache.cache_('codec', 60, lambda: None))
+        self.assertEquals('small', cache.cache_('codec', 60, str, 'small'))
+        self.assertEquals('small', cache.cache_('codec', 60, None, 'small'))
+        values = [dcache.cache.get(key) for key in dcache.cache._cache.keys()]
+        (data,) = [value for value in values
+                   if isinstance(value, str) and value.startswith('Z')]
+        self.assert_(len(data) < 100)
+
+    def test_compress_unencoded(self):
+        """Values stored before the namespace encoded them are
+        recomputed, even if they look like chunk manifests."""
+        fun = lambda: identity() and 'Cat'
+        self.assertEquals('Cat', cache.cache_('codec', 60, fun))
+        cache.configure('codec', compress_threshold=100)
+        self.assertEquals('Cat', cache.cache_('codec', 60, fun))
+        self.assertEquals(2, identity.runcount)
+
+    def test_chunks(self):
+        cache.configure('codec', chunk_size=100)
+        big = range(1000)
+        fun = lambda: identity() and big
+        self.assertEquals(big, cache.cache_('codec', 60, fun))
+        self.assertEquals(big, cache.cache_('codec', 60, fun))
+        self.assertEquals(1, identity.runcount)
+        self.assertEquals([big], cache.cache_many_('codec', 60, fun, [()]))
+        self.assertEquals(1, identity.runcount)
+        self.assert_(len(dcache.cache._cache) > 20)
+
+        # A missing chunk is a miss.
+        chunk = [key for key in dcache.cache._cache.keys()
+                 if key.endswith('.3')][0]
+        dcache.cache.delete(chunk)
+        self.assertEquals(big, cache.cache_('codec', 60, fun))
+        self.assertEquals(2, identity.runcount)
+
+    def test_stats(self):
+        cache.configure('stats', local_size=10)
+        for _ in range(3):
+            cache.cache_('stats', 60, identity, 1)
+        clear_backend()
+        cache.configure('stats', local_size=None)
+        cache.cache_('stats', 60, identity, 1)
+        cache.cache_('stats', 60, identity, 1)
+
+        counters = cache.stats()['stats']
+        self.assertEquals(3, counters['hits'])
+        self.assertEquals(2, counters['local_hits'])
+        self.assertEquals(2, counters['misses'])
+        self.assertEquals(2, counters['computes'])
+        self.assertEquals(0, counters['errors'])
+        self.assertEquals(3, counters['gets'])
+        self.assertEquals(2, counters['sets'])
+        self.assert_(counters['set_bytes'] > 0)
+        cache.log_stats()
+
+        def fail():
+            raise ValueError
+        self.assertRaises(ValueError, cache.cache_, 'stats', 60, fail)
+        self.assertEquals(1, cache.stats()['stats']['errors'])
+
+    def test_stats_sizes(self):
+        """Unencoded values are only pickled for a sample of them."""
+        approx_size, pickled = cache._approx_size, []
+        def counting(value):
+            pickled.append(value)
+            return approx_size(value)
+        cache._approx_size = counting
+        try:
+            cache.cache_many_('sizes', 60, lambda x: '%100d' % x, range(200))
+        finally:
+            cache._approx_size = approx_size
+        self.assertEquals(cache.SIZE_SAMPLE + 2, len(pickled))
+        self.assertEquals(200 * 100, cache.stats()['sizes']['set_bytes'])
+
 
 def test_suite():
     from util.django_layer import make_django_suite
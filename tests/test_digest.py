@@ -0,0 +1,35 @@
+import unittest
+
+from util import sym, storage
+from util.digest import *
+
+class TestDigest(unittest.TestCase):
+    def test_pydigest(self):
+        self.assertEquals('FdcQcnQ49ZHvqxlw', pydigest_str('hello'))
+        self.assertEquals('9ZZljv7D4kEp6rx2', pydigest(('a', 1)))
+
+    def test_canonical_ordering(self):
+        a = dict((x, str(x)) for x in range(100))
+        b = dict((x, str(x)) for x in reversed(range(100)))
+        self.assertEquals(canonical_digest(a), canonical_digest(b))
+        self.assertEquals(canonical_digest(frozenset(range(100))),
+                          canonical_digest(frozenset(reversed(range(100)))))
+
+    def test_canonical_distinct(self):
+        values = ['1', u'1', 1, 1.0, True, None, (1,), [1], ('1',),
+                  {1: 1}, storage(a=1), {'a': 1}, set([1]), frozenset([1]),
+                  sym.a, 'a', ('a', 'b'), ('ab',), (), [], {}, object]
+        digests = set(canonical_digest(value) for value in values)
+        self.assertEquals(len(values), len(digests))
+
+    def test_canonical_str(self):
+        self.assertEquals('t2:s1:ai1;', canonical_str(('a', 1)))
+
+
+def test_suite():
+    from util.django_layer import make_django_suite
+    return make_django_suite(__name__)
+
+
+if __name__ == '__main__':
+    unittest.main()
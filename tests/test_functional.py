@@ -1,7 +1,15 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 import types
 from util import *
 from util.functional import *
+from util.functional import (memoize_key, memoize_, singleton_,
+                             singleton, memoize_zap_cache,
+                             memoize_persistent)
 from functools import partial
 
 class TestMapreduce(unittest.TestCase):
@@ -45,6 +53,19 @@ class TestMapreduce(unittest.TestCase):
         self.assertEquals(100, len(res))
         self.assertEquals(map(lambda x: (x, [x]), range(100)), res)
 
+    def test_workers(self):
+        def mapper(val):
+            yield val % 7, val
+            yield 'all', val
+
+        reducer = lambda key, vals: sum(vals)
+
+        res = mapreduce(mapper, reducer, xrange(1000), workers=3, chunksize=10)
+        self.assert_(isinstance(res, types.GeneratorType))
+        self.assertEquals(dict(mapreduce(mapper, reducer, xrange(1000))),
+                          dict(res))
+        self.assertEquals([], list(mapreduce(mapper, reducer, [], workers=2)))
+
 
 class TestMemoize(unittest.TestCase):
     def test_simple(self):
@@ -77,6 +98,122 @@ class TestMemoize(unittest.TestCase):
                 self.assert_((a, frozenset(kw.iteritems()))
                              in ret.undecorated._cache)
 
+    def test_bounded(self):
+        ns = storage(calls=0)
+        @memoize(maxsize=2)
+        def ret(x):
+            ns.calls += 1
+            return x
+
+        for x in [1, 2, 1, 3, 1, 2]:
+            self.assertEquals(x, ret(x))
+        self.assertEquals(4, ns.calls)
+
+        memoize_zap_cache(ret)
+        self.assertEquals(1, ret(1))
+        self.assertEquals(5, ns.calls)
+        self.assertEquals(1, len(ret.undecorated._cache))
+
+    def test_ttl(self):
+        ns = storage(calls=0)
+        @memoize_key(lambda x, y: x, ttl=0)
+        def ret(x, y):
+            ns.calls += 1
+            return x
+
+        times(3, lambda: ret(1, 2))
+        self.assertEquals(3, ns.calls)
+
+    def test_weak(self):
+        class Value(object):
+            pass
+
+        @memoize(weak=True)
+        def ret(x):
+            return Value()
+
+        value = ret(1)
+        self.assert_(value is ret(1))
+        del value
+        self.assertEquals(0, len(ret.undecorated._cache))
+
+    def test_exception(self):
+        ns = storage(calls=0)
+        @memoize
+        def fail():
+            ns.calls += 1
+            raise ValueError
+
+        self.assertRaises(ValueError, fail)
+        self.assertRaises(ValueError, fail)
+        self.assertEquals(2, ns.calls)
+        self.assertEquals(0, len(fail.undecorated._cache))
+
+    def test_inline(self):
+        ns = storage(calls=0)
+        def ret(x):
+            ns.calls += 1
+            return x
+
+        times(3, lambda: memoize_(ret, 1))
+        times(3, lambda: singleton_(ret, 1))
+        self.assertEquals(2, ns.calls)
+
+    def test_threadsafe(self):
+        ns = storage(calls=0)
+        def mkslow():
+            def slow(x):
+                ns.calls += 1
+                time.sleep(0.1)
+                return x
+            return slow
+
+        slow = mkslow()
+        for memoized in [memoize(mkslow(), threadsafe=True),
+                         singleton(mkslow()),
+                         lambda x: singleton_(slow, x)]:
+            threads = [threading.Thread(target=memoized, args=(x % 2,))
+                       for x in range(10)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEquals(6, ns.calls)
+
+
+class TestMemoizePersistent(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'memo')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def mkfun(self, ns, version):
+        @memoize_persistent(self.path, version)
+        def ret(x, y=None):
+            ns.calls += 1
+            return {'x': x, 'y': y}
+        return ret
+
+    def test_persistent(self):
+        ns = storage(calls=0)
+        ret = self.mkfun(ns, 1)
+        for _ in range(3):
+            self.assertEquals({'x': 1, 'y': 2}, ret(1, y=2))
+            self.assertEquals({'x': 2, 'y': None}, ret(2))
+        self.assertEquals(2, ns.calls)
+
+        # As if in a new process.
+        ret = self.mkfun(ns, 1)
+        self.assertEquals({'x': 1, 'y': 2}, ret(1, y=2))
+        self.assertEquals({'x': 2, 'y': None}, ret(2))
+        self.assertEquals(2, ns.calls)
+
+        ret = self.mkfun(ns, 2)
+        self.assertEquals({'x': 2, 'y': None}, ret(2))
+        self.assertEquals(3, ns.calls)
+
 
 class TestSafe(unittest.TestCase):
     def fail(self):
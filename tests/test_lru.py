@@ -0,0 +1,55 @@
+import time
+import unittest
+
+from util.lru import LRU
+
+class TestLRU(unittest.TestCase):
+    def test_maxsize(self):
+        lru = LRU(maxsize=2)
+        lru['a'] = 1
+        lru['b'] = 2
+        self.assertEquals(1, lru['a'])
+        lru['c'] = 3
+        self.assert_('a' in lru)
+        self.assert_('b' not in lru)
+        self.assert_('c' in lru)
+        self.assertEquals(2, len(lru))
+
+    def test_maxbytes(self):
+        lru = LRU(maxbytes=5)
+        lru['a'] = 'xx'
+        lru['b'] = 'yy'
+        lru['c'] = 'zz'
+        self.assertEquals(None, lru.get('a'))
+        self.assertEquals(4, lru.bytes)
+        lru['d'] = 'too long'
+        self.assertEquals(None, lru.get('d'))
+        self.assertEquals(4, lru.bytes)
+
+    def test_timeout(self):
+        lru = LRU()
+        lru.set('a', 1, timeout=0)
+        lru.set('b', 2, timeout=60)
+        self.assertEquals(None, lru.get('a'))
+        self.assertEquals(2, lru.get('b'))
+        self.assertRaises(KeyError, lru.pop, 'a')
+
+    def test_delete(self):
+        lru = LRU(maxsize=2)
+        lru['a'] = 1
+        del lru['a']
+        self.assertEquals(0, len(lru))
+        self.assertRaises(KeyError, lambda: lru['a'])
+        lru['b'] = None
+        self.assert_('b' in lru)
+        lru.clear()
+        self.assertEquals(0, len(lru))
+
+
+def test_suite():
+    from util.django_layer import make_django_suite
+    return make_django_suite(__name__)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,7 @@
 import unittest
 import random
 from util.mapreduce import mapreduce, serialize, deserialize
+from util.mapreduce import Counters, increment
 
 class TestMapreduce(unittest.TestCase):
     # generate the same stuff in random order, etc. etc. 
@@ -44,6 +45,136 @@ class TestMapreduce(unittest.TestCase):
             #self._basic_mapreduce(1, count=200000)
             self._basic_mapreduce(0, serialized=serialized)
 
+    def test_spill_any_bytes(self):
+        def mapper(val):
+            yield 'a|%d' % (val % 3), '\0%d\0' % val
+
+        def reducer(key, values):
+            return sorted(int(v.strip('\0')) for v in values)
+
+        for mem_limit_mb in [1024, 0]:
+            result = dict(mapreduce(mapper, reducer, range(100),
+                                    mem_limit_mb=mem_limit_mb))
+            self.assertEquals(['a|0', 'a|1', 'a|2'], sorted(result))
+            self.assertEquals(range(1, 100, 3), result['a|1'])
+
+    def test_combiner(self):
+        def mapper(val):
+            yield 'k%d' % (val % 10), '1'
+
+        def reducer(key, values):
+            return sum(map(int, values))
+
+        combined = []
+        def combiner(key, values):
+            values = list(values)
+            combined.append(len(values))
+            return str(sum(map(int, values)))
+
+        for mem_limit_mb in [1024, 0]:
+            del combined[:]
+            result = dict(mapreduce(mapper, reducer, range(1000),
+                                    mem_limit_mb=mem_limit_mb,
+                                    combiner=combiner))
+            self.assertEquals(dict(('k%d' % i, 100) for i in range(10)),
+                              result)
+            if mem_limit_mb:
+                self.assertEquals([], combined)
+            else:
+                self.assert_(combined)
+
+    def test_combiner_serialized(self):
+        @serialize
+        def mapper(val):
+            yield val % 2, val
+
+        @deserialize
+        def reducer(key, values):
+            return sum(values)
+
+        result = dict(mapreduce(mapper, reducer, range(100), mem_limit_mb=0,
+                                combiner=lambda key, values: sum(values)))
+        self.assertEquals({'0': 2450, '1': 2500}, result)
+
+    def test_serialized_in_memory(self):
+        # Values only get serialized when spilled, so reducers get the
+        # mapped objects themselves.
+        mapped = {}
+
+        @serialize
+        def mapper(val):
+            mapped[val] = [val]
+            yield val % 2, mapped[val]
+
+        @deserialize
+        def reducer(key, values):
+            values = list(values)
+            for v in values:
+                self.assert_(v is mapped[v[0]])
+            return sum(v[0] for v in values)
+
+        result = dict(mapreduce(mapper, reducer, range(100),
+                                mem_limit_mb=1024))
+        self.assertEquals({0: 2450, 1: 2500}, result)
+
+    def test_serialized_spill(self):
+        @serialize
+        def mapper(val):
+            yield val % 2, {'val': val, 'bytes': '\0|\n' * val}
+
+        @deserialize
+        def reducer(key, values):
+            values = list(values)
+            for v in values:
+                self.assertEquals('\0|\n' * v['val'], v['bytes'])
+            return sum(v['val'] for v in values)
+
+        result = dict(mapreduce(mapper, reducer, range(100), mem_limit_mb=0))
+        self.assertEquals({'0': 2450, '1': 2500}, result)
+
+    def test_counters(self):
+        def mapper(val):
+            increment('mapped_odd', val % 2)
+            yield 'k%d' % (val % 10), '%d' % val
+
+        def reducer(key, values):
+            increment('reduced')
+            return sum(map(int, values))
+
+        for mem_limit_mb in [1024, 0]:
+            counters = Counters()
+            reports = []
+            output = mapreduce(mapper, reducer, range(100),
+                               mem_limit_mb=mem_limit_mb, counters=counters,
+                               progress=lambda c: reports.append(dict(c)),
+                               progress_interval=0)
+            self.assertEquals(100, counters['records_in'])
+            self.assertEquals(0, counters['records_out'])
+
+            self.assertEquals(10, len(list(output)))
+            self.assertEquals(100, counters['records_mapped'])
+            self.assertEquals(10, counters['records_out'])
+            self.assertEquals(190, counters['bytes_mapped'])
+            self.assertEquals(50, counters['mapped_odd'])
+            self.assertEquals(10, counters['reduced'])
+            self.assertEquals(0 if mem_limit_mb else 100, counters['spills'])
+            for name in ['map_seconds', 'sort_seconds', 'reduce_seconds']:
+                self.assert_(counters[name] >= 0)
+
+            self.assertEquals(111, len(reports))
+            self.assertEquals(dict(counters), reports[-1])
+
+        # Outside of mapreduces, increments go nowhere.
+        increment('mapped_odd')
+
+    def test_spill_levels(self):
+        import util.mapreduce
+        fanin, util.mapreduce.SPILL_FANIN = util.mapreduce.SPILL_FANIN, 4
+        try:
+            self._basic_mapreduce(0, count=1000)
+        finally:
+            util.mapreduce.SPILL_FANIN = fanin
+
 
 def test_suite():
     from util.django_layer import make_django_suite
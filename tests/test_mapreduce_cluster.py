@@ -0,0 +1,77 @@
+import unittest
+import random
+
+from util import *
+from util.mapreduce import mapreduce, serialize, deserialize
+from util.mapreduce import Counters, increment
+from util.mapreduce_cluster import LocalCluster
+
+class TestLocalCluster(unittest.TestCase):
+    def _mapreduce(self, mapper, reducer, data, workers=3, **kwargs):
+        return list(mapreduce(mapper, reducer, data,
+                              backend=LocalCluster(workers=workers,
+                                                   chunksize=100),
+                              **kwargs))
+
+    def test_basic(self):
+        def mapper(val):
+            yield val, '%d' % val
+            yield val - (val % 1000), '%d' % val
+
+        def reducer(key, values):
+            return sorted(map(int, values))
+
+        inp = range(10000)
+        random.shuffle(inp)
+
+        for mem_limit_mb in [1024, 0]:
+            output = self._mapreduce(mapper, reducer, inp,
+                                     mem_limit_mb=mem_limit_mb)
+            self.assertEquals(sorted(str(i) for i in range(10000)),
+                              [key for key, _ in output])
+            for key, value in output:
+                key = int(key)
+                if key % 1000 == 0:
+                    self.assertEquals(1001, len(value))
+                else:
+                    self.assertEquals([key], value)
+
+    def test_serialized_combined(self):
+        @serialize
+        def mapper(val):
+            increment('odd', val % 2)
+            yield val % 10, val
+
+        @deserialize
+        def reducer(key, values):
+            return sum(values)
+
+        counters = Counters()
+        output = self._mapreduce(mapper, reducer, range(1000), workers=2,
+                                 mem_limit_mb=0, counters=counters,
+                                 combiner=lambda key, values: sum(values))
+        self.assertEquals([(str(i), 100 * i + 49500) for i in range(10)],
+                          output)
+        self.assertEquals(1000, counters['records_in'])
+        self.assertEquals(10, counters['records_out'])
+        self.assertEquals(500, counters['odd'])
+
+    def test_worker_error(self):
+        def reducer(key, values):
+            raise ValueError('oops')
+
+        try:
+            self._mapreduce(lambda val: [(val, '')], reducer, range(10))
+        except sym.mapreduce_worker_failed.exc, e:
+            self.assert_('oops' in e.data)
+        else:
+            self.fail()
+
+
+def test_suite():
+    from util.django_layer import make_django_suite
+    return make_django_suite(__name__)
+
+
+if __name__ == '__main__':
+    unittest.main()
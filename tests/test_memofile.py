@@ -0,0 +1,64 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from util.memofile import MemoFile
+
+class TestMemoFile(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'memo')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_basic(self):
+        memo = MemoFile(self.path)
+        self.assertEquals(None, memo.get('a'))
+        memo.put('a', [1, 2, 3])
+        memo.put(('b', 1), None)
+        self.assertEquals([1, 2, 3], memo.get('a'))
+        self.assertEquals(None, memo.get(('b', 1), 'missing'))
+        self.assert_(('b', 1) in memo)
+        self.assertEquals(2, len(memo))
+
+        # First write wins.
+        memo.put('a', 'other')
+        self.assertEquals([1, 2, 3], memo.get('a'))
+
+    def test_shared(self):
+        """Entries written through another handle (eg. by another
+        process) are found."""
+        memo, other = MemoFile(self.path), MemoFile(self.path)
+        self.assertEquals(None, other.get('a'))
+        memo.put('a', 1)
+        self.assertEquals(1, other.get('a'))
+        memo.close()
+        self.assertEquals(1, MemoFile(self.path).get('a'))
+
+    def test_torn(self):
+        memo = MemoFile(self.path)
+        memo.put('a', 1)
+        memo.close()
+
+        f = open(self.path, 'ab')
+        f.write('MEMO' + 'x' * 10)
+        f.close()
+
+        memo = MemoFile(self.path)
+        self.assertEquals(1, memo.get('a'))
+        memo.put('b', 2)
+        memo.close()
+        memo = MemoFile(self.path)
+        self.assertEquals(1, memo.get('a'))
+        self.assertEquals(2, memo.get('b'))
+
+
+def test_suite():
+    from util.django_layer import make_django_suite
+    return make_django_suite(__name__)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,3 +1,5 @@
+import threading
+import time
 import unittest
 import util.once as once
 import util.functional as functional
@@ -17,6 +19,38 @@ class TestOnce(unittest.TestCase):
         self.assertEquals(functional.times(10, myfun), ['result']*10)
         self.assertEquals(ns.runs, 1)
 
+    def test_threads(self):
+        ns = storage()
+        ns.runs = 0
+
+        @once.fun
+        def myfun():
+            ns.runs += 1
+            time.sleep(0.1)
+            return 'result'
+
+        threads = [threading.Thread(target=myfun) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(ns.runs, 1)
+
+    def test_exception(self):
+        ns = storage()
+        ns.runs = 0
+
+        @once.fun
+        def myfun():
+            ns.runs += 1
+            if ns.runs == 1:
+                raise ValueError
+            return 'result'
+
+        self.assertRaises(ValueError, myfun)
+        self.assertEquals(functional.times(2, myfun), ['result']*2)
+        self.assertEquals(ns.runs, 2)
+
 
 def test_suite():
     from util.django_layer import make_django_suite
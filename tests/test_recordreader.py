@@ -0,0 +1,59 @@
+import unittest
+import tempfile
+from cStringIO import StringIO
+
+from util.io import RecordReader
+
+class TestRecordReader(unittest.TestCase):
+    def _files(self, data):
+        """The same data as a buffered (non-regular) and an mmapped
+        (regular) file."""
+        yield StringIO(data)
+
+        f = tempfile.TemporaryFile()
+        f.write(data)
+        f.seek(0)
+        yield f
+
+    def test_split(self):
+        records = ['%d' % i * (i % 7) for i in range(1000)]
+        data = '\0'.join(records)
+        for f in self._files(data):
+            reader = RecordReader(f, buffer_size=16)
+            self.assertEquals(filter(None, records),
+                              list(reader.split('\0')))
+
+    def test_split_long_delim(self):
+        data = 'abc||de|f||||g||'
+        for f in self._files(data):
+            self.assertEquals(['abc', 'de|f', 'g'],
+                              list(RecordReader(f, buffer_size=3).split('||')))
+
+    def test_read(self):
+        data = ''.join(map(str, range(1000)))
+        for f in self._files(data):
+            reader = RecordReader(f, buffer_size=7)
+            self.assertEquals(data[:5], reader.read(5))
+            self.assertEquals(data[5:105], reader.read(100))
+            self.assertEquals(data[105:], ''.join(reader.chunks()))
+            self.assertEquals('', reader.read(5))
+            reader.close()
+
+    def test_offset(self):
+        for f in self._files('skip\0a\0b'):
+            f.seek(5)
+            self.assertEquals(['a', 'b'], list(RecordReader(f).split('\0')))
+
+    def test_empty(self):
+        for f in self._files(''):
+            self.assertEquals([], list(RecordReader(f).split('\0')))
+            self.assertEquals([], list(RecordReader(f).chunks()))
+
+
+def test_suite():
+    from util.django_layer import make_django_suite
+    return make_django_suite(__name__)
+
+
+if __name__ == '__main__':
+    unittest.main()
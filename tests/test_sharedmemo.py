@@ -0,0 +1,89 @@
+import os
+import time
+import unittest
+import multiprocessing
+
+from util.sharedmemo import SharedMemo
+from util.functional import memoize_shared
+
+def forked(fun, n=1):
+    """Run `fun' in `n' forked children and wait for them."""
+    pids = []
+    for _ in range(n):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                fun()
+            finally:
+                os._exit(0)
+        pids.append(pid)
+
+    for pid in pids:
+        os.waitpid(pid, 0)
+
+class TestSharedMemo(unittest.TestCase):
+    def test_basic(self):
+        memo = SharedMemo(size=1 << 20, stripes=4)
+        calls = []
+        compute = lambda x: calls.append(x) or x * 2
+        self.assertEquals(2, memo.get('a', compute, 1))
+        self.assertEquals(2, memo.get('a', compute, 3))
+        self.assert_('a' in memo)
+        self.assert_('b' not in memo)
+        self.assertEquals([1], calls)
+
+    def test_exception(self):
+        memo = SharedMemo(size=1 << 20, stripes=4)
+        def fail():
+            raise ValueError
+        self.assertRaises(ValueError, memo.get, 'a', fail)
+        self.assertEquals(1, memo.get('a', lambda: 1))
+
+    def test_fork(self):
+        memo = SharedMemo(size=1 << 20, stripes=4)
+        calls = multiprocessing.Value('i', 0)
+        def compute():
+            with calls.get_lock():
+                calls.value += 1
+            time.sleep(0.2)
+            return 'value'
+
+        forked(lambda: memo.get('a', compute), n=4)
+        self.assertEquals('value', memo.get('a', compute))
+        self.assertEquals(1, calls.value)
+
+    def test_bounded(self):
+        memo = SharedMemo(size=64 << 10, stripes=1)
+        for i in range(100):
+            self.assertEquals('x' * 1000, memo.get(i, lambda: 'x' * 1000))
+        self.assert_(99 in memo)
+        self.assert_(0 not in memo)
+
+        big = 'x' * (128 << 10)
+        self.assertEquals(big, memo.get('big', lambda: big))
+        self.assert_('big' not in memo)
+
+    def test_memoize_shared(self):
+        @memoize_shared(size=1 << 20, stripes=4)
+        def double(x):
+            return x * 2
+
+        calls = multiprocessing.Value('i', 0)
+        @memoize_shared(size=1 << 20, stripes=4)
+        def counted(x):
+            calls.value += 1
+            return x
+
+        forked(lambda: (double(2), counted(1)))
+        self.assertEquals(4, double(2))
+        self.assertEquals(1, counted(1))
+        self.assertEquals(1, calls.value)
+
+
+def test_suite():
+    from util.django_layer import make_django_suite
+    return make_django_suite(__name__)
+
+
+if __name__ == '__main__':
+    unittest.main()
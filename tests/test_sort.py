@@ -23,6 +23,130 @@ class TestSort(unittest.TestCase):
                 result = list(bigsorted(input, max_memory=max_memory))
                 assert result == ['a', 'b', 'c']
 
+    def test_bigsorted_fanin(self):
+        import random
+        input = [str(random.randrange(1000)) for _ in xrange(1000)]
+        for fanin in [2, 3, 64]:
+            result = list(bigsorted(input, max_memory=10, fanin=fanin))
+            self.assertEqual(sorted(input), result)
+
+    def test_bigsorted_key_cmp(self):
+        input = map(str, range(200))
+        result = list(bigsorted(input, key=int, cmp=lambda x, y: cmp(y, x),
+                                max_memory=20, fanin=4))
+        self.assertEqual(map(str, reversed(range(200))), result)
+
+        # Equal keys keep their order.
+        input = ['%d-%d' % (i % 3, i) for i in range(100)]
+        result = list(bigsorted(input, key=lambda x: x.split('-')[0],
+                                max_memory=20, fanin=3))
+        self.assertEqual(sorted(input, key=lambda x: x.split('-')[0]), result)
+        result = list(bigsorted(input, key=lambda x: x.split('-')[0],
+                                cmp=lambda x, y: cmp(y, x),
+                                max_memory=20, fanin=3))
+        self.assertEqual(sorted(input, key=lambda x: x.split('-')[0],
+                                reverse=True), result)
+
+    def test_bigsorted_stored_keys(self):
+        import random
+        input = range(1000)
+        random.shuffle(input)
+
+        deserialized = []
+        def deserialize(bytes):
+            deserialized.append(bytes)
+            return int(bytes)
+
+        # Order preserving key encoding: compare the bytes.
+        result = list(bigsorted(input, serialize=str, deserialize=deserialize,
+                                max_memory=100, fanin=3,
+                                serialize_key=lambda k: '%08d' % k))
+        self.assertEqual(range(1000), result)
+        # Only the output was deserialized.
+        self.assertEqual(1000, len(deserialized))
+
+        result = list(bigsorted(input, serialize=str, deserialize=int,
+                                key=lambda x: -x, max_memory=100, fanin=3,
+                                serialize_key=str, deserialize_key=int))
+        self.assertEqual(range(999, -1, -1), result)
+
+    def test_bigsorted_workers(self):
+        import random
+        input = range(300)
+        random.shuffle(input)
+        for max_memory in [50, 10000]:
+            result = list(bigsorted(input, serialize=str, deserialize=int,
+                                    key=lambda x: -x, max_memory=max_memory,
+                                    workers=2))
+            self.assertEqual(range(299, -1, -1), result)
+
+        result = list(bigsorted(map(str, input), key=int, max_memory=100,
+                                workers=3,
+                                serialize_key=lambda k: '%08d' % int(k)))
+        self.assertEqual(map(str, range(300)), result)
+
+    def test_bigsorted_blocks(self):
+        import random
+        import util.sort
+        input = ['%d' % random.randrange(100) * random.randrange(20)
+                 for _ in xrange(1000)]
+
+        block_size, util.sort.BLOCK_SIZE = util.sort.BLOCK_SIZE, 50
+        try:
+            for compress in [0, 1, 9]:
+                result = list(bigsorted(input, max_memory=500, fanin=4,
+                                        compress=compress))
+                self.assertEqual(sorted(input), result)
+        finally:
+            util.sort.BLOCK_SIZE = block_size
+
+    def test_bigsorted_replacement(self):
+        import random
+        input = ['%03d' % random.randrange(1000) for _ in xrange(1000)]
+        for max_memory in [0, 30, 300, 10000]:
+            result = list(bigsorted(input, max_memory=max_memory, fanin=4,
+                                    replacement=True))
+            self.assertEqual(sorted(input), result)
+
+        result = list(bigsorted(map(str, range(100)), key=int,
+                                cmp=lambda x, y: cmp(y, x), max_memory=30,
+                                serialize_key=str, deserialize_key=int,
+                                replacement=True))
+        self.assertEqual(map(str, reversed(range(100))), result)
+
+        # Equal keys keep their order.
+        input = ['%d-%d' % (i % 3, i) for i in range(100)]
+        result = list(bigsorted(input, key=lambda x: x.split('-')[0],
+                                max_memory=20, fanin=3, replacement=True))
+        self.assertEqual(sorted(input, key=lambda x: x.split('-')[0]), result)
+        result = list(bigsorted(input, key=lambda x: x.split('-')[0],
+                                cmp=lambda x, y: cmp(y, x), max_memory=20,
+                                fanin=3, replacement=True))
+        self.assertEqual(sorted(input, key=lambda x: x.split('-')[0],
+                                reverse=True), result)
+
+    def test_replacement_runs(self):
+        import os
+        import random
+        from util.sort import _replacement_runs
+
+        def runs(input):
+            tmpfiles = []
+            left = _replacement_runs(tmpfiles, input, lambda x: x, cmp, str,
+                                     300, None, None, 0)
+            for name in tmpfiles:
+                os.remove(name)
+            return len(tmpfiles), sum(map(len, left.values()))
+
+        # Presorted input makes a single file.
+        self.assertEqual((1, 0), runs(['%04d' % i for i in range(1000)]))
+
+        # Random input makes files of about twice the memory: 12000
+        # bytes in 300 make about 20, rather than 40.
+        input = ['%04d' % random.randrange(10000) for _ in xrange(3000)]
+        files, left = runs(input)
+        self.assert_(15 <= files <= 25, files)
+
 def test_suite():
     from util.django_layer import make_django_suite
     return make_django_suite(__name__)
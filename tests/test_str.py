@@ -10,6 +10,10 @@ class TestStr(unittest.TestCase):
         # Verify that odd-length strings choke
         self.assertRaises(TypeError, compress_hex_to_alphanumeric, '4')
 
+    def test_compress_bytes(self):
+        self.assertEquals('e', compress_bytes('\x42'))
+        self.assertEquals('ba', compress_bytes('\x01\x02', alphabet='ab'))
+
 
 def test_suite():
     from util.django_layer import make_django_suite